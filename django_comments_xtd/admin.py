@@ -1,10 +1,148 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR
 from django.contrib.comments.admin import CommentsAdmin
-from django.utils.translation import ugettext_lazy as _
+from django.contrib.comments.models import CommentFlag
+from django.db import connections
+from django.db.models import Max, Min
+from django.db.models.query import QuerySet
+from django.utils.translation import ugettext_lazy as _, ungettext
 
 from django_comments_xtd.models import XtdComment
 
 
+ADMIN_PERFORMANCE_MODE = getattr(settings,
+                                 'COMMENTS_XTD_ADMIN_PERFORMANCE_MODE', False)
+ADMIN_ESTIMATED_COUNT_THRESHOLD = getattr(
+    settings, 'COMMENTS_XTD_ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000)
+
+
+def estimated_count(model, using):
+    """
+    Number of rows in the table of model according to the statistics of the
+    database planner, or None if the database does not keep them.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == 'mysql':
+        sql = ("SELECT table_rows FROM information_schema.tables "
+               "WHERE table_schema = DATABASE() AND table_name = %s")
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [model._meta.db_table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+PK_RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte')
+
+
+class EstimatedCountQuerySet(QuerySet):
+    """
+    QuerySet whose count() is estimated from the statistics of the database
+    planner when they say there are more than ADMIN_ESTIMATED_COUNT_THRESHOLD
+    rows: of the whole table, or of a range of primary keys, as set by the
+    keyset navigation of the admin, in proportion to its share of the range
+    of the table. Otherwise filtered querysets are counted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(EstimatedCountQuerySet, self).__init__(*args, **kwargs)
+        self._pk_range = None # lookup -> value of the pk range filters
+
+    def _clone(self, *args, **kwargs):
+        clone = super(EstimatedCountQuerySet, self)._clone(*args, **kwargs)
+        clone._pk_range = self._pk_range
+        return clone
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        clone = super(EstimatedCountQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+        if not args and not kwargs:
+            return clone
+        clone._pk_range = None
+        if negate or args or (self.query.where and self._pk_range is None):
+            return clone
+        pk_range = dict(self._pk_range or {})
+        pk_names = self._pk_names()
+        for lookup, value in kwargs.items():
+            name, _, lookup_type = lookup.partition('__')
+            if name not in pk_names or lookup_type not in PK_RANGE_LOOKUPS:
+                return clone
+            try:
+                pk_range[lookup_type] = int(value)
+            except (TypeError, ValueError):
+                return clone
+        clone._pk_range = pk_range
+        return clone
+
+    def _pk_names(self):
+        """
+        Names the primary key can be filtered by: with multi-table
+        inheritance, as XtdComment, the ones of the parent link and of the
+        primary keys of the parents too, like id.
+        """
+        names = set(['pk'])
+        opts = self.model._meta
+        while True:
+            pk = opts.pk
+            names.update([pk.name, pk.attname])
+            if not (pk.rel and pk.rel.parent_link):
+                return names
+            opts = pk.rel.to._meta
+
+    def count(self):
+        query = self.query
+        if (not query.low_mark and query.high_mark is None and
+                (not query.where or self._pk_range is not None)):
+            estimate = estimated_count(self.model, self.db)
+            if (estimate is not None and
+                    estimate >= ADMIN_ESTIMATED_COUNT_THRESHOLD):
+                if query.where:
+                    return self._estimate_pk_range(estimate)
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+    def _estimate_pk_range(self, estimate):
+        # min and max are read from the primary key index
+        bounds = QuerySet(self.model, using=self.db).aggregate(
+            lo=Min('pk'), hi=Max('pk'))
+        if bounds['lo'] is None:
+            return 0
+        lo, hi = bounds['lo'], bounds['hi']
+        pk_range = self._pk_range
+        if 'gt' in pk_range:
+            lo = max(lo, pk_range['gt'] + 1)
+        if 'gte' in pk_range:
+            lo = max(lo, pk_range['gte'])
+        if 'lt' in pk_range:
+            hi = min(hi, pk_range['lt'] - 1)
+        if 'lte' in pk_range:
+            hi = min(hi, pk_range['lte'])
+        if hi < lo:
+            return 0
+        return int(estimate * float(hi - lo + 1) /
+                   (bounds['hi'] - bounds['lo'] + 1))
+
+
+def older_comments_url(cl):
+    """
+    URL of the changelist page with the comments older than the last one
+    of cl, that filters by primary key instead of counting an offset, or
+    None when cl is the last page or is not sorted newest first.
+    """
+    if ORDER_VAR in cl.params:
+        return None
+    results = list(cl.result_list)
+    if len(results) < cl.list_per_page:
+        return None
+    return cl.get_query_string({'id__lt': results[-1].pk}, [PAGE_VAR])
+
+
 class XtdCommentsAdmin(CommentsAdmin):
     list_display = ('thread_level', 'cid', 'name', 'content_type', 'object_pk', 'ip_address', 'submit_date', 'followup', 'is_public', 'is_removed')
     list_display_links = ('cid',)
@@ -19,6 +157,37 @@ class XtdCommentsAdmin(CommentsAdmin):
     date_hierarchy = 'submit_date'
     ordering = ('thread_id', 'order')
 
+    def queryset(self, request):
+        qs = super(XtdCommentsAdmin, self).queryset(request)
+        return qs.select_related('user', 'content_type', 'site')
+
+    # The moderation actions of CommentsAdmin, run in bulk.
+
+    def flag_comments(self, request, queryset):
+        self._bulk_moderate(request, queryset, CommentFlag.SUGGEST_REMOVAL,
+                            lambda n: ungettext('flagged', 'flagged', n))
+    flag_comments.short_description = _("Flag selected comments")
+
+    def approve_comments(self, request, queryset):
+        self._bulk_moderate(request, queryset,
+                            CommentFlag.MODERATOR_APPROVAL,
+                            lambda n: ungettext('approved', 'approved', n))
+    approve_comments.short_description = _("Approve selected comments")
+
+    def remove_comments(self, request, queryset):
+        self._bulk_moderate(request, queryset,
+                            CommentFlag.MODERATOR_DELETION,
+                            lambda n: ungettext('removed', 'removed', n))
+    remove_comments.short_description = _("Remove selected comments")
+
+    def _bulk_moderate(self, request, queryset, flag, done_message):
+        n_comments = XtdComment.objects.moderate(queryset, flag, request.user)
+        msg = ungettext(u'1 comment was successfully %(action)s.',
+                        u'%(count)s comments were successfully %(action)s.',
+                        n_comments)
+        self.message_user(request, msg % {'count': n_comments,
+                                          'action': done_message(n_comments)})
+
     def thread_level(self, obj):
         rep = '|'
         if obj.level:
@@ -31,4 +200,33 @@ class XtdCommentsAdmin(CommentsAdmin):
     def cid(self, obj):
         return 'c%d' % obj.id
 
-admin.site.register(XtdComment, XtdCommentsAdmin)
+
+class XtdCommentsPerformanceAdmin(XtdCommentsAdmin):
+    """
+    XtdCommentsAdmin for large tables, registered when
+    COMMENTS_XTD_ADMIN_PERFORMANCE_MODE is True: no date drill-down, that
+    aggregates the whole table, newest first by primary key with a link to
+    the older comments, estimated counts and no select boxes listing every
+    user.
+    """
+    date_hierarchy = None
+    ordering = ('-id',)
+    raw_id_fields = ('content_type', 'user')
+
+    def queryset(self, request):
+        qs = super(XtdCommentsPerformanceAdmin, self).queryset(request)
+        return qs._clone(klass=EstimatedCountQuerySet)
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(XtdCommentsPerformanceAdmin, self).changelist_view(
+            request, extra_context)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            context['older_comments_url'] = older_comments_url(context['cl'])
+        return response
+
+
+if ADMIN_PERFORMANCE_MODE:
+    admin.site.register(XtdComment, XtdCommentsPerformanceAdmin)
+else:
+    admin.site.register(XtdComment, XtdCommentsAdmin)
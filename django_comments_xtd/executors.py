@@ -0,0 +1,167 @@
+"""
+Executors run the follow-up notification of new comments out of the
+request/response cycle. The view posting a comment only submits the id of
+the new comment; finding followers, loading the target object and rendering
+the emails happens in the executor.
+
+The executor is chosen with the setting COMMENTS_XTD_NOTIFICATION_EXECUTOR:
+
+ * ``django_comments_xtd.executors.ThreadPoolExecutor``: a pool of worker
+   threads in the web process (the default).
+ * ``django_comments_xtd.executors.DatabaseQueueExecutor``: jobs are stored
+   in the database and run by the ``xtd_process_notifications`` command.
+ * ``django_comments_xtd.executors.SyncExecutor``: jobs run before the view
+   returns. Meant for tests.
+"""
+
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from django_comments_xtd.models import NotificationJob, XtdComment
+from django_comments_xtd.utils import load_class, on_commit
+
+
+NOTIFICATION_EXECUTOR = getattr(
+    settings, 'COMMENTS_XTD_NOTIFICATION_EXECUTOR',
+    'django_comments_xtd.executors.ThreadPoolExecutor')
+NOTIFICATION_THREADS = getattr(settings, 'COMMENTS_XTD_NOTIFICATION_THREADS', 2)
+
+# Jobs claimed at once by DatabaseQueueExecutor.process.
+CLAIM_BATCH_SIZE = 100
+
+logger = logging.getLogger("django_comments_xtd")
+
+
+def run_notification_job(comment_id):
+    """
+    Notify the followers of the conversation of the given comment. Returns
+    False if the comment is not found.
+    """
+    from django_comments_xtd.views import notify_comment_followers
+
+    try:
+        comment = XtdComment.objects.get(pk=comment_id)
+    except XtdComment.DoesNotExist:
+        return False
+    notify_comment_followers(comment)
+    return True
+
+
+class SyncExecutor(object):
+    """Runs the job right away, in the thread of the request."""
+
+    def submit(self, comment_id):
+        run_notification_job(comment_id)
+
+
+class ThreadPoolExecutor(object):
+    """
+    Runs jobs in a pool of daemon threads, started on the first submit.
+
+    Jobs are queued once the transaction that saved their comment ends, see
+    utils.on_commit, so that the threads find it. Jobs of comments whose
+    transaction was rolled back find nothing and are dropped.
+    """
+
+    def __init__(self, num_threads=NOTIFICATION_THREADS):
+        self.num_threads = num_threads
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, comment_id):
+        on_commit(self._put, comment_id)
+
+    def _put(self, comment_id):
+        if not self.threads:
+            self._start()
+        self.queue.put(comment_id)
+
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            comment_id = self.queue.get()
+            try:
+                self._run(comment_id)
+            except Exception:
+                logger.exception("Notification of comment %s failed",
+                                 comment_id)
+            finally:
+                # every thread has its own connection, do not leak them
+                connection.close()
+                self.queue.task_done()
+
+    def _run(self, comment_id):
+        if not run_notification_job(comment_id):
+            logger.warning("Notification of comment %s not sent: comment "
+                           "not found", comment_id)
+
+
+class DatabaseQueueExecutor(object):
+    """
+    Stores jobs in the NotificationJob table. Run them with the management
+    command ``xtd_process_notifications``.
+    """
+
+    def submit(self, comment_id):
+        NotificationJob.objects.create(comment_id=comment_id)
+
+    def claim(self, limit):
+        """
+        Take up to limit jobs out of the queue, in order of arrival, and
+        return the ids of their comments. Jobs are locked while they are
+        claimed, so concurrent runs never get the same job.
+        """
+        with transaction.commit_on_success():
+            jobs = list(NotificationJob.objects.select_for_update().values_list(
+                'pk', 'comment_id')[:limit])
+            NotificationJob.objects.filter(
+                pk__in=[pk for pk, comment_id in jobs]).delete()
+        return [comment_id for pk, comment_id in jobs]
+
+    def process(self, limit=None):
+        """Run the pending jobs in order of arrival. Return how many ran."""
+        count = 0
+        while limit is None or count < limit:
+            batch_size = CLAIM_BATCH_SIZE
+            if limit is not None:
+                batch_size = min(batch_size, limit - count)
+            comment_ids = self.claim(batch_size)
+            if not comment_ids:
+                break
+            # Claimed jobs are out of the queue: a failed job is not
+            # retried, as the emails of some followers might have been
+            # sent already.
+            for comment_id in comment_ids:
+                try:
+                    if not run_notification_job(comment_id):
+                        logger.warning("Notification of comment %s not "
+                                       "sent: comment not found", comment_id)
+                except Exception:
+                    logger.exception("Notification of comment %s failed",
+                                     comment_id)
+                count += 1
+        return count
+
+
+_executor = None
+
+def get_notification_executor():
+    global _executor
+    if _executor is None:
+        _executor = load_class(NOTIFICATION_EXECUTOR,
+                               'COMMENTS_XTD_NOTIFICATION_EXECUTOR')()
+    return _executor
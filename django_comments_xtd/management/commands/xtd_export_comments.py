@@ -0,0 +1,179 @@
+import csv
+import gzip
+import json
+import os
+import sys
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils.dateparse import parse_date, parse_datetime
+
+from django_comments_xtd.models import XtdComment
+from django_comments_xtd.utils import get_content_types
+
+
+FIELDS = ('id', 'content_type', 'object_pk', 'site', 'user', 'user_name',
+          'user_email', 'user_url', 'comment', 'submit_date', 'ip_address',
+          'is_public', 'is_removed', 'thread_id', 'parent_id', 'level',
+          'order', 'followup')
+
+
+def _parse_date(value):
+    date = parse_datetime(value)
+    if date is None:
+        date = parse_date(value)
+    if date is None:
+        raise CommandError("Invalid date: %r" % value)
+    return date
+
+
+def _read_high_water_mark(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        value = f.read().strip()
+    try:
+        return int(value or 0)
+    except ValueError:
+        raise CommandError("Invalid high-water mark in %s: %r" % (path,
+                                                                   value))
+
+
+def _write_high_water_mark(path, last_id):
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, 'w') as f:
+        f.write("%d\n" % last_id)
+    os.rename(tmp_path, path)
+
+
+class JSONLinesWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        self.stream.write(json.dumps(dict(zip(FIELDS, row))))
+        self.stream.write("\n")
+
+
+class CSVWriter(object):
+    def __init__(self, stream):
+        self.writer = csv.writer(stream)
+
+    def writeheader(self):
+        self.writer.writerow(FIELDS)
+
+    def writerow(self, row):
+        self.writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ])
+
+
+WRITERS = {'jsonl': JSONLinesWriter, 'csv': CSVWriter}
+
+
+class Command(NoArgsCommand):
+    help = ("Writes the comments as JSON lines or CSV, reading them in "
+            "chunks so that memory use does not grow with the table.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+                    choices=sorted(WRITERS.keys()),
+                    help='Output format: jsonl (default) or csv.'),
+        make_option('--output', dest='output', default='-',
+                    help='File to write to. Defaults to the standard '
+                    'output.'),
+        make_option('--gzip', action='store_true', dest='gzip',
+                    default=False,
+                    help='Compress the output. Implied when the output '
+                    'file ends in .gz.'),
+        make_option('--content-type', action='append', dest='content_types',
+                    default=[], metavar='APP.MODEL',
+                    help='Export only comments to this app.model. Can be '
+                    'given more than once.'),
+        make_option('--since', dest='since', default=None,
+                    help='Export only comments submitted at or after this '
+                    'date.'),
+        make_option('--until', dest='until', default=None,
+                    help='Export only comments submitted before this date.'),
+        make_option('--state-file', dest='state_file', default=None,
+                    help='File keeping the id of the last exported comment. '
+                    'Only comments posted after it are exported, and it is '
+                    'updated when the export ends.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of comments read per query.'),
+    )
+
+    def get_queryset(self, options):
+        qs = XtdComment.objects.all()
+        try:
+            content_types = get_content_types(options['content_types'])
+        except (ValueError, ContentType.DoesNotExist), e:
+            raise CommandError(e)
+        if content_types:
+            qs = qs.filter(content_type__in=content_types)
+        if options['since']:
+            qs = qs.filter(submit_date__gte=_parse_date(options['since']))
+        if options['until']:
+            qs = qs.filter(submit_date__lt=_parse_date(options['until']))
+        return qs.order_by('pk').values_list(*FIELDS)
+
+    def iter_rows(self, qs, last_id, chunk_size):
+        """
+        Rows of qs with id greater than last_id. Each chunk is selected
+        by id from where the previous one ended, so every query reads
+        chunk_size rows at most, whatever the size of the table.
+        """
+        while True:
+            rows = list(qs.filter(pk__gt=last_id)[:chunk_size])
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+
+    def handle_noargs(self, **options):
+        state_file = options['state_file']
+        last_id = state_file and _read_high_water_mark(state_file) or 0
+        qs = self.get_queryset(options)
+
+        output = options['output']
+        if output == '-':
+            fileobj = sys.stdout
+        else:
+            fileobj = open(output, 'wb')
+        stream = fileobj
+        if options['gzip'] or output.endswith('.gz'):
+            stream = gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+        writer = WRITERS[options['format']](stream)
+        writer.writeheader()
+        count = 0
+        try:
+            for row in self.iter_rows(qs, last_id, options['chunk_size']):
+                row = list(row)
+                row[1] = self._app_model(row[1])
+                row[9] = row[9].isoformat()
+                writer.writerow(row)
+                last_id = row[0]
+                count += 1
+        finally:
+            if stream is not fileobj:
+                stream.close()
+            if fileobj is sys.stdout:
+                fileobj.flush()
+            else:
+                fileobj.close()
+
+        if state_file:
+            _write_high_water_mark(state_file, last_id)
+        if int(options.get('verbosity', 1)) > 1:
+            sys.stderr.write("Exported %d comments\n" % count)
+
+    def _app_model(self, content_type_id):
+        ct = ContentType.objects.get_for_id(content_type_id)
+        return "%s.%s" % (ct.app_label, ct.model)
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from django_comments_xtd import views
+from django_comments_xtd.executors import DatabaseQueueExecutor
+
+
+class Command(NoArgsCommand):
+    help = ("Sends the follow-up notifications queued by the "
+            "DatabaseQueueExecutor, and the digests whose window has closed.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Maximum number of jobs to process.'),
+    )
+
+    def handle_noargs(self, **options):
+        count = DatabaseQueueExecutor().process(limit=options['limit'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Processed %d notification jobs\n" % count)
+        if views.NOTIFY_DIGEST_WINDOW:
+            count = views.send_due_digests()
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write("Sent %d digests\n" % count)
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from django_comments_xtd.pending import get_pending_store
+
+
+class Command(NoArgsCommand):
+    help = ("Deletes the comments waiting for confirmation for longer than "
+            "COMMENTS_XTD_PENDING_TTL seconds.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of comments deleted per statement.'),
+    )
+
+    def handle_noargs(self, **options):
+        store = get_pending_store()
+        if store is None:
+            raise CommandError("COMMENTS_XTD_PENDING_STORE is not set")
+        count = store.purge(chunk_size=options['chunk_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Deleted %d pending comments\n" % count)
@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from django_comments_xtd.models import XtdComment
+from django_comments_xtd.utils import (bump_comments_version,
+                                       render_comment_html)
+
+
+def _init_worker():
+    # Connections can not be shared with the parent process.
+    connection.close()
+
+
+def rerender_range(pk_range):
+    """
+    Render again the markup of the comments with pk in [start, end) and
+    write the changed ones back with bulk UPDATEs in one transaction, then
+    invalidate what is cached for the comments of their objects.
+    Returns (end, updated).
+    """
+    start, end = pk_range
+    rows = XtdComment.objects.filter(pk__gte=start, pk__lt=end).values_list(
+        'pk', 'comment', 'comment_html', 'content_type_id', 'object_pk')
+    changed = []
+    objects = set()
+    for pk, comment, comment_html, content_type_id, object_pk in rows:
+        new_html = render_comment_html(comment)
+        if new_html != comment_html:
+            changed.append((pk, new_html))
+            objects.add((content_type_id, object_pk))
+    if changed:
+        _bulk_update_comment_html(changed)
+        for content_type_id, object_pk in objects:
+            bump_comments_version(content_type_id, object_pk)
+    return end, len(changed)
+
+
+# Rows per UPDATE statement, keeping its parameters under SQLite's limit.
+UPDATE_BATCH_SIZE = 300
+
+
+@transaction.commit_on_success
+def _bulk_update_comment_html(changed):
+    qn = connection.ops.quote_name
+    pk_column = qn(XtdComment._meta.pk.column)
+    cursor = connection.cursor()
+    for i in xrange(0, len(changed), UPDATE_BATCH_SIZE):
+        batch = changed[i:i + UPDATE_BATCH_SIZE]
+        sql = "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+            qn(XtdComment._meta.db_table), qn('comment_html'), pk_column,
+            " ".join(["WHEN %s THEN %s"] * len(batch)), pk_column,
+            ", ".join(["%s"] * len(batch)))
+        params = []
+        for pk, comment_html in batch:
+            params.extend([pk, comment_html])
+        params.extend([pk for pk, comment_html in batch])
+        cursor.execute(sql, params)
+
+
+def _read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        value = f.read().strip()
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError("Invalid checkpoint in %s: %r" % (path, value))
+
+
+def _write_checkpoint(path, pk):
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, 'w') as f:
+        f.write("%d\n" % pk)
+    os.rename(tmp_path, path)
+
+
+class Command(NoArgsCommand):
+    help = ("Renders again the markup of the comments and stores it in "
+            "comment_html. Run it after upgrading or changing the formatter.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Width of the primary key ranges rendered by each '
+                    'task.'),
+        make_option('--processes', type='int', dest='processes',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of worker processes. Defaults to the '
+                    'number of CPUs.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File keeping the primary key up to which all '
+                    'comments are done. The command resumes from it, and '
+                    'deletes it when it finishes.'),
+    )
+
+    def get_ranges(self, start, chunk_size):
+        bounds = XtdComment.objects.aggregate(min_pk=Min('pk'),
+                                              max_pk=Max('pk'))
+        if bounds['max_pk'] is None:
+            return []
+        if start is None:
+            start = bounds['min_pk']
+        return [(lo, lo + chunk_size)
+                for lo in xrange(start, bounds['max_pk'] + 1, chunk_size)]
+
+    def handle_noargs(self, **options):
+        checkpoint = options['checkpoint']
+        ranges = self.get_ranges(_read_checkpoint(checkpoint),
+                                 options['chunk_size'])
+        processes = max(options['processes'], 1)
+        if processes > 1 and len(ranges) > 1:
+            connection.close()
+            pool = multiprocessing.Pool(processes, initializer=_init_worker)
+            # imap returns results in order, so every range before the one
+            # returned is done too, and the checkpoint is safe to move on.
+            results = pool.imap(rerender_range, ranges)
+        else:
+            pool = None
+            results = (rerender_range(pk_range) for pk_range in ranges)
+
+        count = 0
+        try:
+            for end, updated in results:
+                count += updated
+                if checkpoint:
+                    _write_checkpoint(checkpoint, end)
+        finally:
+            if pool is not None:
+                # all results are in unless the loop failed
+                pool.terminate()
+                pool.join()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Updated %d comments\n" % count)
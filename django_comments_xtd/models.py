@@ -1,16 +1,40 @@
+from hashlib import sha1
+
 from myproject.utils import get_dictionary_with_cache_priority
 from django.conf import settings
-from django.contrib.comments.models import Comment
+from django.contrib.comments.models import Comment, CommentFlag
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
-from django.db import models, transaction
-from django.db.models import F, Max, Min
+from django.db import connections, models, transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.contrib.auth import get_user_model 
+
+from django_comments_xtd import signals
+from django_comments_xtd.stream import publish_comment_on_commit
+from django_comments_xtd.utils import (bump_comments_version,
+                                       get_content_types,
+                                       render_comment_html)
+
 MAX_THREAD_LEVEL = getattr(settings, 'COMMENTS_XTD_MAX_THREAD_LEVEL', 0)
 MAX_THREAD_LEVEL_BY_APP_MODEL = getattr(settings, 'COMMENTS_XTD_MAX_THREAD_LEVEL_BY_APP_MODEL', {})
 
+# Comments per statement in XtdComment.objects.moderate and delete_subtree,
+# keeping the IN lists under SQLite's limit of parameters.
+MODERATE_BATCH_SIZE = 500
+
+# Comments per statement when tree_for_object counts the replies to the
+# comments of a level and reads the comments shown, under SQLite's limit of
+# parameters.
+TREE_BATCH_SIZE = 500
+
+# Parents per statement when tree_for_object selects the first replies to
+# each of them, keeping under SQLite's limits of parameters and of SELECTs
+# in a compound statement.
+REPLIES_BATCH_SIZE = 100
+
 
 def max_thread_level_for_content_type(content_type):
     app_model = "%s.%s" % (content_type.app_label, content_type.model)
@@ -20,6 +44,58 @@ def max_thread_level_for_content_type(content_type):
         return MAX_THREAD_LEVEL
 
 
+def comment_fingerprint(comment):
+    """
+    Hash of the author, object, parent, body and submit date of an XtdComment
+    or a TmpXtdComment. Two comments with the same fingerprint are the same.
+    """
+    submit_date = comment.submit_date
+    if timezone.is_aware(submit_date):
+        submit_date = timezone.make_naive(submit_date, timezone.utc)
+    content_type_id = comment.content_type_id or comment.content_type.pk
+    # top level comments get parent_id = id once saved
+    parent_id = comment.parent_id
+    if parent_id == comment.pk:
+        parent_id = 0
+    values = [comment.user_name, comment.user_email, content_type_id,
+              comment.object_pk, parent_id or 0, comment.comment,
+              submit_date.isoformat()]
+    return sha1(
+        u"\x00".join([unicode(v or u"") for v in values]).encode('utf8')
+    ).hexdigest()
+
+
+def build_comment_tree(comments, root_id=None):
+    """
+    Nest comments, given in thread order, in one pass. Every comment comes
+    after its parent in thread order, so it is attached to the node of its
+    parent_id. Top level comments, and the replies to the comment root_id,
+    are the roots. Comments whose parent is not among the given ones, ie:
+    replies to a comment that is not public, are left out with their own
+    replies. Returns the list of top level nodes, see tree_for_object.
+    """
+    roots = []
+    nodes = {}
+    for comment in comments:
+        node = {'comment': comment, 'children': []}
+        if comment.parent_id == comment.pk or comment.parent_id == root_id:
+            roots.append(node)
+        elif comment.parent_id in nodes:
+            nodes[comment.parent_id]['children'].append(node)
+        else:
+            continue
+        nodes[comment.pk] = node
+    return roots
+
+
+class CommentTree(list):
+    """
+    List of the top level nodes of a tree of comments, see tree_for_object.
+    more is the number of top level comments left out.
+    """
+    more = 0
+
+
 class MaxThreadLevelExceededException(Exception):
     def __init__(self, content_type=None):
         self.max_by_app = max_thread_level_for_content_type(content_type)
@@ -31,17 +107,327 @@ class MaxThreadLevelExceededException(Exception):
 class XtdCommentManager(models.Manager):
     def for_app_models(self, *args):
         """Return XtdComments for pairs "app.model" given in args"""
-        content_types = []
-        for app_model in args:
-            app, model = app_model.split(".")
-            content_types.append(ContentType.objects.get(app_label=app, 
-                                                         model=model))
-        return self.for_content_types(content_types)
+        return self.for_content_types(get_content_types(args))
 
     def for_content_types(self, content_types):
         qs = self.get_query_set().filter(content_type__in=content_types).reverse()
         return qs
 
+    def for_object(self, content_type, object_pk):
+        """Public XtdComments to the given object, in thread order."""
+        return self.get_query_set().filter(content_type=content_type,
+                                           object_pk=object_pk,
+                                           is_public=True)
+
+    def for_display(self, comments=None):
+        """
+        Evaluate comments, a queryset of XtdComments (by default all of
+        them), with their user, content_type and site, and with the
+        content_object of all of them fetched in one query per content type.
+        Returns a list ready to be rendered without further queries.
+        """
+        if comments is None:
+            comments = self.get_query_set()
+        comments = list(comments.select_related('user', 'content_type',
+                                                'site'))
+        self.model.prefetch_content_objects(comments)
+        return comments
+
+    def tree_for_object(self, content_type, object_pk, root=None,
+                        max_depth=None, max_children=None, skip=0):
+        """
+        Public XtdComments to the given object as a tree: a CommentTree
+        with the top level comments, each one a dict with the comment in
+        'comment' and the list of its replies, alike, in 'children'. Replies
+        to comments that are not public are left out.
+
+        With root, a comment, the tree holds only its replies. skip leaves
+        out that many comments of the top level. With max_depth only that
+        many levels are loaded, and with max_children only the first that
+        many replies to each comment, and that many top level comments.
+        Nodes with replies left out get their number in 'more', and the
+        tree in its attribute more.
+
+        Without max_children comments are loaded with one ordered query, see
+        build_comment_tree. With it, with a few queries per level that only
+        read the comments shown, so that the cost of the tree is bounded
+        whatever the size of the discussion.
+        """
+        qs = self.for_object(content_type, object_pk)
+        base_level = 0
+        if root is not None:
+            base_level = root.level + 1
+            qs = qs.filter(thread_id=root.thread_id, order__gt=root.order)
+            end = self._subtree_end(root)
+            if end is not None:
+                qs = qs.filter(order__lt=end)
+        last_level = None
+        if max_depth is not None:
+            last_level = base_level + max_depth - 1
+        root_id = root is not None and root.pk or None
+
+        if max_children is not None:
+            return self._limited_tree(qs, root_id, base_level, last_level,
+                                      max_children, skip)
+
+        more = {}
+        if last_level is not None:
+            more = dict(qs.filter(level=last_level + 1).values_list(
+                'parent_id').annotate(Count('pk')).order_by())
+            qs = qs.filter(level__lte=last_level)
+        tree = CommentTree(build_comment_tree(
+            self.for_display(qs.order_by('thread_id', 'order')),
+            root_id=root_id)[skip:])
+        if more:
+            stack = list(tree)
+            while stack:
+                node = stack.pop()
+                if node['comment'].level == last_level:
+                    node['more'] = more.get(node['comment'].pk, 0)
+                stack.extend(node['children'])
+        return tree
+
+    def _limited_tree(self, qs, root_id, base_level, last_level,
+                      max_children, skip):
+        """
+        Tree of the comments of qs with at most max_children replies per
+        comment, see tree_for_object. Reads level by level the first
+        replies to the comments kept in the level above, and counts the
+        rest.
+        """
+        top = qs.filter(level=base_level)
+        if root_id is not None:
+            top = top.filter(parent_id=root_id)
+        total = top.count()
+        ids = list(top.order_by('thread_id', 'order').values_list(
+            'pk', flat=True)[skip:skip + max_children])
+        comment_ids = list(ids)
+        more = {}
+        level = base_level
+        while ids:
+            level += 1
+            counts = {}
+            for i in xrange(0, len(ids), TREE_BATCH_SIZE):
+                counts.update(qs.filter(
+                    level=level, parent_id__in=ids[i:i + TREE_BATCH_SIZE]
+                ).values_list('parent_id').annotate(Count('pk')).order_by())
+            if last_level is not None and level > last_level:
+                more.update(counts)
+                break
+            replies = self._first_replies(qs.filter(level=level), ids,
+                                          max_children)
+            shown = {}
+            for pk, parent_id in replies:
+                shown[parent_id] = shown.get(parent_id, 0) + 1
+            for parent_id, count in counts.iteritems():
+                if count > shown.get(parent_id, 0):
+                    more[parent_id] = count - shown.get(parent_id, 0)
+            ids = [pk for pk, parent_id in replies]
+            comment_ids.extend(ids)
+
+        comments = []
+        for i in xrange(0, len(comment_ids), TREE_BATCH_SIZE):
+            comments.extend(self.for_display(qs.filter(
+                pk__in=comment_ids[i:i + TREE_BATCH_SIZE])))
+        comments.sort(key=lambda c: (c.thread_id, c.order))
+        tree = CommentTree(build_comment_tree(comments, root_id=root_id))
+        tree.more = max(total - skip - len(tree), 0)
+        if more:
+            stack = list(tree)
+            while stack:
+                node = stack.pop()
+                if node['comment'].pk in more:
+                    node['more'] = more[node['comment'].pk]
+                stack.extend(node['children'])
+        return tree
+
+    def _first_replies(self, qs, parent_ids, limit):
+        """
+        (pk, parent_id) of the first limit comments of qs replying to each
+        of parent_ids, in thread order. One UNION ALL of a LIMITed SELECT
+        per parent, so only the rows returned are read.
+        """
+        connection = connections[self.db]
+        rows = []
+        for i in xrange(0, len(parent_ids), REPLIES_BATCH_SIZE):
+            parts, params = [], []
+            for n, parent_id in enumerate(
+                    parent_ids[i:i + REPLIES_BATCH_SIZE]):
+                sql, part_params = qs.filter(parent_id=parent_id).order_by(
+                    'order').values_list('pk', 'parent_id')[:limit].query.\
+                    get_compiler(self.db).as_sql()
+                parts.append("SELECT * FROM (%s) %s" % (
+                    sql, connection.ops.quote_name("r%d" % n)))
+                params.extend(part_params)
+            cursor = connection.cursor()
+            cursor.execute(" UNION ALL ".join(parts), params)
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def _subtree_end(self, comment):
+        """
+        Order of the first comment of the thread after the replies to the
+        given one, where the thread gets back to its level, or None if the
+        replies run to the end of the thread.
+        """
+        return self.get_query_set().filter(
+            thread_id=comment.thread_id, order__gt=comment.order,
+            level__lte=comment.level).aggregate(Min('order'))['order__min']
+
+    def delete_subtree(self, comment, compact=False):
+        """
+        Delete the given comment and all its replies, found by their range
+        of order in the thread, with one DELETE per table instead of one
+        per comment. With compact=True the comments after them in the
+        thread are moved up to close the hole left in order.
+
+        No post_delete signal is sent for each comment: subtree_deleted is
+        sent once instead. Returns the number of comments deleted.
+        """
+        with transaction.commit_on_success():
+            # Lock the rows of the thread, so that replies posted meanwhile,
+            # which shift the order of the comments after them, wait for
+            # the range to be deleted. The range is read from the locked
+            # rows, not from comment, that may be stale.
+            rows = self.get_query_set().select_for_update().filter(
+                thread_id=comment.thread_id).order_by('order').values_list(
+                'pk', 'order', 'level')
+            comment_ids = []
+            start = end = None
+            for pk, order, level in rows:
+                if start is None:
+                    if pk == comment.pk:
+                        start, start_level = order, level
+                        comment_ids.append(pk)
+                elif level <= start_level:
+                    end = order
+                    break
+                else:
+                    comment_ids.append(pk)
+            if not comment_ids:
+                return 0
+            subtree = self.get_query_set().filter(thread_id=comment.thread_id,
+                                                  order__gte=start)
+            if end is not None:
+                subtree = subtree.filter(order__lt=end)
+            CommentFlag.objects.filter(
+                comment__in=subtree.values('pk'))._raw_delete(self.db)
+            subtree.order_by()._raw_delete(self.db)
+            for i in xrange(0, len(comment_ids), MODERATE_BATCH_SIZE):
+                Comment.objects.filter(
+                    pk__in=comment_ids[i:i + MODERATE_BATCH_SIZE]
+                )._raw_delete(self.db)
+            if compact and end is not None:
+                self.get_query_set().filter(
+                    thread_id=comment.thread_id, order__gte=end
+                ).update(order=F('order') - len(comment_ids))
+
+        signals.subtree_deleted.send(sender=self.model, comment=comment,
+                                     comment_ids=comment_ids)
+        return len(comment_ids)
+
+    def page_for_object(self, content_type, object_pk, after=None,
+                        page_size=20, whole_threads=False):
+        """
+        Page of the XtdComments to the given object following the cursor
+        after, a (thread_id, order) pair, in thread order. Returns the list
+        of comments and the cursor of the next page, or None if it is the
+        last one. The comments of the previous pages are not read and
+        skipped as with an offset, but the comments of the object are
+        still joined and sorted for every page: they are filtered in the
+        table of Comment and sorted in the one of XtdComment, so no index
+        serves both.
+
+        With whole_threads=True, page_size is the number of threads in the
+        page, and threads are never split between pages.
+        """
+        qs = self.for_object(content_type, object_pk).order_by('thread_id',
+                                                               'order')
+        if whole_threads:
+            threads = qs.order_by('thread_id').values_list(
+                'thread_id', flat=True).distinct()
+            if after is not None:
+                threads = threads.filter(thread_id__gt=after[0])
+            thread_ids = list(threads[:page_size + 1])
+            has_next = len(thread_ids) > page_size
+            comments = self.for_display(
+                qs.filter(thread_id__in=thread_ids[:page_size]))
+        else:
+            if after is not None:
+                thread_id, order = after
+                qs = qs.filter(Q(thread_id__gt=thread_id) |
+                               Q(thread_id=thread_id, order__gt=order))
+            comments = self.for_display(qs[:page_size + 1])
+            has_next = len(comments) > page_size
+            comments = comments[:page_size]
+        if has_next and comments:
+            next_cursor = (comments[-1].thread_id, comments[-1].order)
+        else:
+            next_cursor = None
+        return comments, next_cursor
+
+    def moderate(self, comments, flag, user):
+        """
+        Flag, approve or remove the given comments, a queryset, at once. 
+        flag is one of CommentFlag.SUGGEST_REMOVAL, MODERATOR_APPROVAL and
+        MODERATOR_DELETION. Comments are updated with one UPDATE, flags are
+        created with bulk_create, and the signal comments_moderated is sent
+        once for all of them. Returns the number of comments.
+        """
+        rows = list(comments.values_list('pk', 'content_type_id',
+                                         'object_pk').order_by())
+        comment_ids = [pk for pk, ctype_id, object_pk in rows]
+        if not comment_ids:
+            return 0
+        if flag == CommentFlag.MODERATOR_APPROVAL:
+            changes = {'is_public': True, 'is_removed': False}
+        elif flag == CommentFlag.MODERATOR_DELETION:
+            changes = {'is_removed': True}
+        else:
+            changes = None
+
+        with transaction.commit_on_success():
+            flagged = set()
+            for i in xrange(0, len(comment_ids), MODERATE_BATCH_SIZE):
+                batch = comment_ids[i:i + MODERATE_BATCH_SIZE]
+                if changes:
+                    Comment.objects.filter(pk__in=batch).update(**changes)
+                flagged.update(CommentFlag.objects.filter(
+                    comment__in=batch, user=user, flag=flag
+                ).values_list('comment_id', flat=True))
+            now = timezone.now()
+            CommentFlag.objects.bulk_create([
+                CommentFlag(comment_id=pk, user=user, flag=flag,
+                            flag_date=now)
+                for pk in comment_ids if pk not in flagged
+            ])
+
+        objects = set((ctype_id, object_pk)
+                      for pk, ctype_id, object_pk in rows)
+        signals.comments_moderated.send(sender=self.model,
+                                        comment_ids=comment_ids,
+                                        objects=objects, flag=flag,
+                                        user=user)
+        return len(comment_ids)
+
+    def comments_since(self, content_type, object_pk, after_id=None,
+                       since=None):
+        """
+        Public XtdComments to the given object posted after the comment 
+        after_id, or after the datetime since, in order of arrival. Both
+        are range scans over an index of the comments table, on content
+        type, object_pk and id or submit_date. Prefer after_id: comments
+        are returned in order of id.
+        """
+        qs = self.get_query_set().filter(content_type=content_type,
+                                         object_pk=object_pk,
+                                         is_public=True, is_removed=False)
+        if after_id is not None:
+            qs = qs.filter(pk__gt=after_id)
+        if since is not None:
+            qs = qs.filter(submit_date__gt=since)
+        return qs.order_by('pk')
+
 
 class XtdComment(Comment):
     thread_id = models.IntegerField(default=0, db_index=True)
@@ -49,13 +435,25 @@ class XtdComment(Comment):
     level = models.SmallIntegerField(default=0)
     order = models.IntegerField(default=1, db_index=True)
     followup = models.BooleanField(default=False, help_text=_("Receive by email further comments in this conversation"), blank=True)
+    fingerprint = models.CharField(max_length=40, unique=True, null=True,
+                                   blank=True, editable=False)
+    comment_html = models.TextField(blank=True, editable=False, default='')
     objects = XtdCommentManager()
 
     class Meta:
         ordering = ('thread_id', 'order')
+        index_together = [('thread_id', 'order')]
 
     def save(self, *args, **kwargs):
         is_new = self.pk == None
+        if is_new:
+            # what Comment.save does, which is skipped below, and the
+            # fingerprint needs a datetime
+            self.submit_date = self._meta.get_field('submit_date').to_python(
+                self.submit_date) or timezone.now()
+            if not self.fingerprint:
+                self.fingerprint = comment_fingerprint(self)
+        self.comment_html = self.get_comment_html()
         super(Comment, self).save(*args, **kwargs)
         if is_new:
             if not self.parent_id:
@@ -69,6 +467,9 @@ class XtdComment(Comment):
                     raise MaxThreadLevelExceededException(self.content_type)
             kwargs["force_insert"] = False
             super(Comment, self).save(*args, **kwargs)
+            if self.is_public and not self.is_removed:
+                # now that it has its place in the thread
+                publish_comment_on_commit(self)
 
     def _calculate_thread_data(self):
         # Implements the following approach:
@@ -91,6 +492,13 @@ class XtdComment(Comment):
             max_order = qc_eq_thread.aggregate(Max('order'))['order__max']
             self.order = max_order + 1
 
+    def get_comment_html(self):
+        """
+        HTML of the comment when it starts with a markup language line, or
+        an empty string, stored in comment_html on save.
+        """
+        return render_comment_html(self.comment)
+
     @models.permalink
     def get_reply_url(self):
         return ("comments-xtd-reply", None, {"cid": self.pk})
@@ -171,6 +579,88 @@ class XtdComment(Comment):
             context["totalUsers"] = object_count - 1
         return context
 
+    @classmethod
+    def prefetch_content_objects(cls, comments, select_related=()):
+        """
+        Fill the content_object cache of the given comments with one query
+        per content type. Fields of the content objects named in
+        select_related are fetched along with them, if their model has them.
+        The cache of comments whose content object no longer exists is set
+        to None, so that reading it does not query again.
+        """
+        pks_by_ctype = {}
+        for comment in comments:
+            pks_by_ctype.setdefault(comment.content_type_id, set()).add(
+                comment.object_pk)
+        objects_by_ctype = {}
+        for ctype_id, object_pks in pks_by_ctype.iteritems():
+            model = ContentType.objects.get_for_id(ctype_id).model_class()
+            qs = model._default_manager.all()
+            names = [f.name for f in model._meta.fields]
+            related = [name for name in select_related if name in names]
+            if related:
+                qs = qs.select_related(*related)
+            pks = [model._meta.pk.to_python(pk) for pk in object_pks]
+            objects_by_ctype[ctype_id] = dict(
+                (unicode(k), v) for k, v in qs.in_bulk(pks).iteritems())
+
+        object_cache = cls.content_object.cache_attr
+        for comment in comments:
+            setattr(comment, object_cache,
+                    objects_by_ctype[comment.content_type_id].get(
+                        unicode(comment.object_pk)))
+
+    @classmethod
+    def prefetch_notification_relations(cls, comments):
+        """
+        Fill the caches of user, content_type and content_object (with its
+        album) of the given comments with a few bulk queries, so that
+        building their notification contexts does not hit the database.
+        """
+        user_ids = set(c.user_id for c in comments if c.user_id)
+        users = get_user_model()._default_manager.in_bulk(list(user_ids))
+        cls.prefetch_content_objects(comments, select_related=('album',))
+
+        user_cache = cls._meta.get_field('user').get_cache_name()
+        ctype_cache = cls._meta.get_field('content_type').get_cache_name()
+        for comment in comments:
+            setattr(comment, ctype_cache,
+                    ContentType.objects.get_for_id(comment.content_type_id))
+            if comment.user_id in users:
+                setattr(comment, user_cache, users[comment.user_id])
+
+    @classmethod
+    def get_notification_contexts(cls, groups):
+        """
+        Batch version of get_notification_context. Takes a list of
+        (notification_type, objects) pairs and returns the list of their
+        contexts, in the same order. The relations used by the contexts are
+        loaded in bulk for all the groups at once, so the number of queries
+        does not depend on the number of groups.
+
+        Comments whose content object no longer exists are left out of their
+        group, as there is no item to tell about, and groups left empty get
+        None instead of a context.
+        """
+        groups = [(notification_type, list(objects))
+                  for notification_type, objects in groups]
+        comments = {}
+        for notification_type, objects in groups:
+            for obj in objects:
+                comments[id(obj)] = obj
+        cls.prefetch_notification_relations(comments.values())
+        object_cache = cls.content_object.cache_attr
+        contexts = []
+        for notification_type, objects in groups:
+            objects = [obj for obj in objects
+                       if getattr(obj, object_cache) is not None]
+            if objects:
+                contexts.append(cls.get_notification_context(
+                    notification_type, objects=objects))
+            else:
+                contexts.append(None)
+        return contexts
+
     def get_user_status(self, user, privacy, album_owner_id):
         status = "user"
         if user.id == settings.ANONYMOUS_USER_ID or user is None:
@@ -318,6 +808,64 @@ class XtdComment(Comment):
         base_dict["can_delete"] = unicode(user.id) in who_can_delete
         return base_dict
 
+def comment_changed(sender, instance, **kwargs):
+    bump_comments_version(instance.content_type_id, instance.object_pk)
+
+def comments_were_moderated(sender, objects, **kwargs):
+    for content_type_id, object_pk in objects:
+        bump_comments_version(content_type_id, object_pk)
+
+def subtree_deleted(sender, comment, comment_ids, **kwargs):
+    bump_comments_version(comment.content_type_id, comment.object_pk)
+    keys = []
+    for pk in comment_ids:
+        keys.append("_comment_dict_%d_" % pk)
+        keys.append("_num_likes_for_comment_%d_" % pk)
+    cache.delete_many(keys)
+
+models.signals.post_save.connect(comment_changed, sender=XtdComment)
+models.signals.post_delete.connect(comment_changed, sender=XtdComment)
+signals.comments_moderated.connect(comments_were_moderated,
+                                   sender=XtdComment)
+signals.subtree_deleted.connect(subtree_deleted, sender=XtdComment)
+
+
+class NotificationJob(models.Model):
+    """
+    Follow-up notification of a new comment waiting in the database queue.
+    """
+    comment_id = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('id',)
+
+
+class DigestEntry(models.Model):
+    """
+    Comment waiting in the follow-up digest of its object, see
+    COMMENTS_XTD_NOTIFY_DIGEST_WINDOW. The oldest entry of an object opens
+    its window.
+    """
+    content_type_id = models.IntegerField()
+    object_pk = models.CharField(max_length=255)
+    comment_id = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ('id',)
+        index_together = [('content_type_id', 'object_pk')]
+
+
+class PendingComment(models.Model):
+    """
+    Comment waiting for the confirmation of its author, packed with
+    signed.pack_comment and base64 encoded.
+    """
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
 class DummyDefaultManager:
     """
     Dummy Manager to mock django's CommentForm.check_for_duplicate method.
@@ -0,0 +1,104 @@
+"""
+Stores for the comments waiting for the confirmation of their authors.
+
+By default the whole comment travels signed in the confirmation URL. When
+COMMENTS_XTD_PENDING_STORE is set, the comment is kept in the given store
+and the URL only carries its signed id:
+
+ * ``django_comments_xtd.pending.DatabasePendingStore`` keeps them in the
+   PendingComment table. Run ``xtd_purge_pending_comments`` to remove the
+   ones nobody confirmed.
+ * ``django_comments_xtd.pending.CachePendingStore`` keeps them in the
+   Django cache, that expires them by itself.
+
+Comments are kept COMMENTS_XTD_PENDING_TTL seconds.
+"""
+
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from django_comments_xtd import signed
+from django_comments_xtd.models import PendingComment
+from django_comments_xtd.utils import load_class
+
+
+PENDING_STORE = getattr(settings, 'COMMENTS_XTD_PENDING_STORE', None)
+PENDING_TTL = getattr(settings, 'COMMENTS_XTD_PENDING_TTL', 7 * 24 * 3600)
+
+
+class DatabasePendingStore(object):
+    def add(self, comment):
+        """Keep the comment, return its id."""
+        data = signed.encode(signed.pack_comment(comment))
+        return PendingComment.objects.create(data=data).pk
+
+    def get(self, pk):
+        """Return the TmpXtdComment with the given id, or None."""
+        try:
+            pending = PendingComment.objects.get(
+                pk=pk, created__gte=timezone.now() - timedelta(
+                    seconds=PENDING_TTL))
+        except PendingComment.DoesNotExist:
+            return None
+        # the database returns the TextField as unicode, base64 wants bytes
+        return signed.unpack_comment(signed.decode(str(pending.data)))
+
+    def delete(self, pk):
+        PendingComment.objects.filter(pk=pk).delete()
+
+    def purge(self, chunk_size=1000):
+        """
+        Delete the comments older than PENDING_TTL, chunk_size rows per
+        statement. Return how many were deleted.
+        """
+        cutoff = timezone.now() - timedelta(seconds=PENDING_TTL)
+        expired = PendingComment.objects.filter(created__lt=cutoff)
+        count = 0
+        while True:
+            pks = list(expired.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return count
+            PendingComment.objects.filter(pk__in=pks).delete()
+            count += len(pks)
+
+
+class CachePendingStore(object):
+    def __init__(self):
+        self.random = random.SystemRandom()
+
+    def _key(self, pk):
+        return "_xtd_pending_comment_%d_" % pk
+
+    def add(self, comment):
+        packed = signed.pack_comment(comment)
+        while True:
+            pk = self.random.getrandbits(63)
+            if cache.add(self._key(pk), packed, PENDING_TTL):
+                return pk
+
+    def get(self, pk):
+        packed = cache.get(self._key(pk))
+        if packed is None:
+            return None
+        return signed.unpack_comment(packed)
+
+    def delete(self, pk):
+        cache.delete(self._key(pk))
+
+    def purge(self, chunk_size=1000):
+        # the cache expires the entries by itself
+        return 0
+
+
+_store = None
+
+def get_pending_store():
+    """The store set in COMMENTS_XTD_PENDING_STORE, or None."""
+    global _store
+    if _store is None and PENDING_STORE:
+        _store = load_class(PENDING_STORE, 'COMMENTS_XTD_PENDING_STORE')()
+    return _store
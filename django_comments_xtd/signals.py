@@ -6,3 +6,15 @@ from django.dispatch import Signal
 # Sent just after a comment has been verified.
 confirmation_received = Signal(providing_args=["comment", "request"])
 
+
+# Sent once after XtdComment.objects.moderate has flagged, approved or
+# removed a set of comments, instead of one signal per comment.
+# comment_ids is the list of their ids, and objects the set of
+# (content_type_id, object_pk) they belong to.
+comments_moderated = Signal(providing_args=["comment_ids", "objects", "flag",
+                                            "user"])
+
+# Sent once after XtdComment.objects.delete_subtree has deleted comment and
+# its replies, instead of one post_delete per comment. comment_ids is the
+# list of the ids of all of them.
+subtree_deleted = Signal(providing_args=["comment", "comment_ids"])
@@ -35,13 +35,35 @@ start of the base64 pickle.
 
 There are 65 url-safe characters: the 64 used by url-safe base64 and the '.'. 
 These functions make use of all of them.
+
+The comments waiting for confirmation use a second, more compact format. 
+dumps_comment() packs only the fields of the comment in a fixed binary layout
+and signs it with a HMAC/SHA256 tag truncated to 128 bits. Those tokens start
+with a '~'. loads_comment() never unpickles: fields are read from their fixed
+positions and the decompressed size is bounded. The pickled tokens of 
+previous versions are only accepted when COMMENTS_XTD_ACCEPT_PICKLED_TOKENS is
+True, and even then they are loaded with an unpickler restricted to the 
+classes of a comment.
 """
 
 import pickle, base64
+import struct
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 from django.conf import settings
-from hashlib import sha1 as sha_constructor
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from hashlib import sha1 as sha_constructor, sha256
 import hmac
 
+
+# Largest size a comment token may have once decompressed.
+MAX_TOKEN_SIZE = getattr(settings, 'COMMENTS_XTD_MAX_TOKEN_SIZE', 64 * 1024)
+
+# Whether loads_comment() accepts the pickled tokens created by dumps().
+ACCEPT_PICKLED_TOKENS = getattr(settings, 
+                                'COMMENTS_XTD_ACCEPT_PICKLED_TOKENS', False)
+
 def dumps(obj, key = None, compress = False, extra_key = ''):
     """
     Returns URL-safe, sha1 signed base64 compressed pickle. If key is 
@@ -120,3 +142,251 @@ def unsign(signed_value, key = None):
 
 def base64_hmac(value, key):
     return encode(hmac.new(key, value, sha_constructor).digest())
+
+
+# Comment token format, version 2.
+#
+# The signed value is a flags byte followed by the fields of the comment,
+# compressed with zlib when the flags say so. The fields are a fixed size
+# header followed by the text fields. Each text field is prefixed with its
+# length but the last one, the comment, that takes the rest of the value.
+
+COMMENT_TOKEN_PREFIX = '~'
+COMMENT_TAG_SIZE = 16 # bytes of the HMAC/SHA256 kept in the token
+COMMENT_ID_TOKEN_PREFIX = '!'
+
+_COMMENT_ID = struct.Struct('!Q')
+
+_FLAG_COMPRESSED = 1
+
+_IS_PUBLIC, _IS_REMOVED, _FOLLOWUP, _AWARE = 1, 2, 4, 8
+
+_COMMENT_HEADER = struct.Struct('!BIIIIIhIq')
+_COMMENT_HEADER_FIELDS = ('content_type_id', 'site_id', 'user_id', 
+                          'thread_id', 'parent_id', 'level', 'order')
+_COMMENT_TEXT_FIELDS = ('object_pk', 'user_name', 'user_email', 'user_url',
+                        'ip_address')
+_TEXT_LENGTH = struct.Struct('!H')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _datetime_to_int(value):
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+def _int_to_datetime(value):
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def pack_comment(comment):
+    """Binary representation of the fields of a TmpXtdComment."""
+    flags = 0
+    if comment.is_public:
+        flags |= _IS_PUBLIC
+    if comment.is_removed:
+        flags |= _IS_REMOVED
+    if comment.followup:
+        flags |= _FOLLOWUP
+    submit_date = comment.submit_date
+    if timezone.is_aware(submit_date):
+        flags |= _AWARE
+        submit_date = timezone.make_naive(submit_date, timezone.utc)
+    if comment.content_type is not None:
+        content_type_id = comment.content_type.pk
+    else:
+        content_type_id = comment.content_type_id
+    user = comment.user
+    user_id = user.pk if user is not None else comment.user_id
+    values = { 'content_type_id': content_type_id, 'user_id': user_id or 0 }
+    for name in _COMMENT_HEADER_FIELDS[1:]:
+        values.setdefault(name, int(comment.get(name) or 0))
+    header = _COMMENT_HEADER.pack(
+        flags, *([values[name] for name in _COMMENT_HEADER_FIELDS] +
+                 [_datetime_to_int(submit_date)]))
+    chunks = [header]
+    for name in _COMMENT_TEXT_FIELDS:
+        text = unicode(comment.get(name) or u'').encode('utf8')
+        chunks.append(_TEXT_LENGTH.pack(len(text)))
+        chunks.append(text)
+    chunks.append(unicode(comment.comment or u'').encode('utf8'))
+    return ''.join(chunks)
+
+def unpack_comment(packed):
+    """Reverse of pack_comment(), returns a TmpXtdComment."""
+    from django.contrib.contenttypes.models import ContentType
+    from django_comments_xtd.models import TmpXtdComment
+
+    try:
+        fields = _COMMENT_HEADER.unpack_from(packed)
+        offset = _COMMENT_HEADER.size
+        texts = []
+        for name in _COMMENT_TEXT_FIELDS:
+            length, = _TEXT_LENGTH.unpack_from(packed, offset)
+            offset += _TEXT_LENGTH.size
+            if offset + length > len(packed):
+                raise ValueError("Truncated comment token")
+            texts.append(packed[offset:offset + length].decode('utf8'))
+            offset += length
+        texts.append(packed[offset:].decode('utf8'))
+    except struct.error, e:
+        raise ValueError("Malformed comment token: %s" % e)
+
+    flags, submit_date = fields[0], _int_to_datetime(fields[-1])
+    if flags & _AWARE:
+        submit_date = timezone.make_aware(submit_date, timezone.utc)
+    comment = TmpXtdComment()
+    comment.update(zip(_COMMENT_HEADER_FIELDS, fields[1:-1]))
+    comment.update(zip(_COMMENT_TEXT_FIELDS + ('comment',), texts))
+    try:
+        comment['content_type'] = ContentType.objects.get_for_id(
+            comment.pop('content_type_id'))
+    except ContentType.DoesNotExist:
+        raise ValueError("Comment token for an unknown content type")
+    if not comment['user_id']:
+        del comment['user_id']
+    if not comment['ip_address']:
+        comment['ip_address'] = None
+    comment['submit_date'] = submit_date
+    comment['is_public'] = bool(flags & _IS_PUBLIC)
+    comment['is_removed'] = bool(flags & _IS_REMOVED)
+    comment['followup'] = bool(flags & _FOLLOWUP)
+    return comment
+
+
+def dumps_comment(comment, key = None, compress = False, extra_key = ''):
+    """
+    Returns a URL-safe token for the given TmpXtdComment, signed with a 
+    truncated HMAC/SHA256. Fields other than the ones of XtdComment are not
+    kept in the token.
+    """
+    packed = pack_comment(comment)
+    flags = 0
+    if compress:
+        import zlib
+        compressed = zlib.compress(packed)
+        if len(compressed) < len(packed):
+            packed = compressed
+            flags |= _FLAG_COMPRESSED
+    value = encode(chr(flags) + packed)
+    tag = comment_tag(value, (key or settings.SECRET_KEY) + extra_key)
+    return COMMENT_TOKEN_PREFIX + value + '.' + tag
+
+def loads_comment(s, key = None, extra_key = ''):
+    """
+    Reverse of dumps_comment(). Tokens created by dumps() are accepted too
+    when ACCEPT_PICKLED_TOKENS is True. Raises ValueError if the signature 
+    fails or if the token is not a valid comment.
+    """
+    if isinstance(s, unicode):
+        s = s.encode('utf8')
+    if not s.startswith(COMMENT_TOKEN_PREFIX):
+        return _loads_pickled_comment(s, key, extra_key)
+    if not '.' in s:
+        raise BadSignature, 'Missing sig (no . found in value)'
+    value, tag = s[len(COMMENT_TOKEN_PREFIX):].rsplit('.', 1)
+    if not constant_time_compare(
+            comment_tag(value, (key or settings.SECRET_KEY) + extra_key), tag):
+        raise BadSignature, 'Signature failed: %s' % tag
+    try:
+        data = decode(value)
+    except TypeError:
+        raise ValueError("Malformed comment token")
+    if not data:
+        raise ValueError("Empty comment token")
+    flags, packed = ord(data[0]), data[1:]
+    if flags & _FLAG_COMPRESSED:
+        packed = _decompress(packed)
+    elif len(packed) > MAX_TOKEN_SIZE:
+        raise ValueError("Comment token too large")
+    return unpack_comment(packed)
+
+def _decompress(data):
+    """zlib.decompress that refuses to produce more than MAX_TOKEN_SIZE."""
+    import zlib
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, MAX_TOKEN_SIZE)
+    except zlib.error, e:
+        raise ValueError("Malformed comment token: %s" % e)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Comment token too large")
+    return result
+
+
+# Classes a pickled TmpXtdComment is allowed to refer to.
+_PICKLED_COMMENT_CLASSES = frozenset([
+    ('django_comments_xtd.models', 'TmpXtdComment'),
+    ('django.contrib.contenttypes.models', 'ContentType'),
+    ('django.db.models.base', 'model_unpickle'),
+    ('django.db.models.base', 'simple_class_factory'),
+    ('django.db.models.base', 'ModelState'),
+    ('copy_reg', '_reconstructor'),
+    ('__builtin__', 'object'),
+    ('datetime', 'datetime'),
+    ('django.utils.timezone', 'UTC'),
+    ('pytz', '_UTC'),
+])
+
+class _CommentUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) not in _PICKLED_COMMENT_CLASSES:
+            raise ValueError("Class %s.%s not allowed in a comment token" % (
+                module, name))
+        return pickle.Unpickler.find_class(self, module, name)
+
+def _loads_pickled_comment(s, key, extra_key):
+    if not ACCEPT_PICKLED_TOKENS:
+        raise ValueError("Pickled comment tokens are not accepted")
+    base64d = unsign(s, (key or settings.SECRET_KEY) + extra_key)
+    if base64d[:1] == '.':
+        pickled = _decompress(decode(base64d[1:]))
+    else:
+        pickled = decode(base64d)
+        if len(pickled) > MAX_TOKEN_SIZE:
+            raise ValueError("Comment token too large")
+    try:
+        comment = _CommentUnpickler(StringIO(pickled)).load()
+    except (pickle.UnpicklingError, EOFError, 
+            AttributeError, ImportError, IndexError, KeyError), e:
+        raise ValueError("Malformed comment token: %s" % e)
+    if not isinstance(comment, dict):
+        raise ValueError("Malformed comment token")
+    # Go through the schema of the compact format, so that only the fields 
+    # of a comment, with the right types, come out of a pickled token.
+    try:
+        return unpack_comment(pack_comment(comment))
+    except (AttributeError, TypeError, struct.error), e:
+        raise ValueError("Malformed comment token: %s" % e)
+
+def dumps_comment_id(pk, key = None, extra_key = ''):
+    """
+    Returns a short URL-safe token for the id of a comment kept in a pending
+    comments store. Signed like dumps_comment().
+    """
+    value = encode(_COMMENT_ID.pack(pk))
+    tag = comment_tag(value, (key or settings.SECRET_KEY) + extra_key)
+    return COMMENT_ID_TOKEN_PREFIX + value + '.' + tag
+
+def loads_comment_id(s, key = None, extra_key = ''):
+    "Reverse of dumps_comment_id(), raises ValueError if signature fails"
+    if isinstance(s, unicode):
+        s = s.encode('utf8')
+    if not s.startswith(COMMENT_ID_TOKEN_PREFIX) or not '.' in s:
+        raise BadSignature, 'Not a comment id token'
+    value, tag = s[len(COMMENT_ID_TOKEN_PREFIX):].rsplit('.', 1)
+    if not constant_time_compare(
+            comment_tag(value, (key or settings.SECRET_KEY) + extra_key), tag):
+        raise BadSignature, 'Signature failed: %s' % tag
+    try:
+        pk, = _COMMENT_ID.unpack(decode(value))
+    except (TypeError, struct.error):
+        raise ValueError("Malformed comment id token")
+    return pk
+
+def comment_tag(value, key):
+    # The key is derived so that a tag is never valid as a SHA1 signature
+    # made by sign() with the same secret, or the other way around.
+    derived_key = sha256('django_comments_xtd.signed.comment' + key).digest()
+    digest = hmac.new(derived_key, value, sha256).digest()
+    return encode(digest[:COMMENT_TAG_SIZE])
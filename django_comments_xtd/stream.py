@@ -0,0 +1,110 @@
+"""
+Publish/subscribe of new comments, so that the view ``comments-xtd-stream``
+can hold the requests of clients waiting for comments to an object and
+answer them as soon as one is posted, instead of being polled.
+
+XtdComment.save publishes the id of every new public comment in the channel
+of its object, once the transaction saving it commits, see
+publish_comment_on_commit. The broker is given by COMMENTS_XTD_STREAM_BROKER.
+The default, LocalBroker, keeps subscriptions in memory and so only wakes up
+clients waiting in the same process. Clients waiting in other processes 
+notice the new comments when their wait times out, as the version of the 
+comments of the object, kept in the cache, has changed.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from django_comments_xtd.utils import load_class, on_commit
+
+
+STREAM_BROKER = getattr(settings, 'COMMENTS_XTD_STREAM_BROKER',
+                        'django_comments_xtd.stream.LocalBroker')
+STREAM_TIMEOUT = getattr(settings, 'COMMENTS_XTD_STREAM_TIMEOUT', 25)
+STREAM_MAX_AGE = getattr(settings, 'COMMENTS_XTD_STREAM_MAX_AGE', 300)
+
+
+def get_channel(content_type_id, object_pk):
+    return "%d:%s" % (content_type_id, object_pk)
+
+
+class LocalBroker(object):
+    """
+    In-process broker. It only remembers the last comment published in the
+    channels somebody is waiting on, so it does not grow with the number of
+    objects commented.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}   # channel -> (Condition, number of waiters)
+        self.last_ids = {}  # channel -> id of the last comment published
+
+    def publish(self, channel, comment_id):
+        with self.lock:
+            if channel not in self.waiters:
+                return
+            self.last_ids[channel] = max(comment_id,
+                                         self.last_ids.get(channel, 0))
+            self.waiters[channel][0].notify_all()
+
+    def wait(self, channel, after_id, timeout):
+        """
+        Block until a comment newer than after_id is published in the
+        channel or until timeout seconds pass. Return the id of the newest
+        comment published in the first case, and None in the second.
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            condition, count = self.waiters.get(
+                channel, (threading.Condition(self.lock), 0))
+            self.waiters[channel] = (condition, count + 1)
+            try:
+                while self.last_ids.get(channel, 0) <= after_id:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    condition.wait(remaining)
+                return self.last_ids[channel]
+            finally:
+                condition, count = self.waiters[channel]
+                if count == 1:
+                    del self.waiters[channel]
+                    self.last_ids.pop(channel, None)
+                else:
+                    self.waiters[channel] = (condition, count - 1)
+
+
+_broker = None
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = load_class(STREAM_BROKER, 'COMMENTS_XTD_STREAM_BROKER')()
+    return _broker
+
+
+def publish_comment(comment):
+    """Tell the clients waiting for comments to its object about comment."""
+    get_broker().publish(
+        get_channel(comment.content_type_id, comment.object_pk), comment.pk)
+
+
+def publish_comment_on_commit(comment):
+    """
+    Publish comment once the transaction that saved it commits, so that
+    the clients woken up find it. See utils.on_commit.
+    """
+    if transaction.is_managed():
+        on_commit(_publish_saved_comment, comment)
+    else:
+        on_commit(publish_comment, comment)
+
+
+def _publish_saved_comment(comment):
+    # not if its transaction was rolled back
+    if type(comment)._default_manager.filter(pk=comment.pk).exists():
+        publish_comment(comment)
@@ -1,32 +1,73 @@
 #-*- coding: utf-8 -*-
 
-import re
+from hashlib import md5
 
 from django.contrib.contenttypes.models import ContentType
-from django.template import (Library, Node, TemplateSyntaxError,
-                             Variable, loader, RequestContext)
+from django.core.cache import cache
+from django.template import Library, Node, TemplateSyntaxError, Variable
 from django.utils.safestring import mark_safe
 
 from django_comments_xtd.models import XtdComment
 
-from ..utils import import_formatter
+from ..utils import (formatter, get_comment_template, get_comments_version,
+                     get_content_types,
+                     render_comments, render_comment_tree, render_markup,
+                     LRUCache, MarkupNotAvailable, MARKUP_CACHE_SIZE,
+                     TREE_MAX_CHILDREN, TREE_MAX_DEPTH)
 
 
-formatter = import_formatter()
-
 register = Library()
 
 
-class XtdCommentCountNode(Node):
+class BaseXtdCommentsNode(Node):
+    """
+    Base class of the nodes for a list of app.model. Content types are
+    resolved on first render, so that loading templates hits no database.
+    """
+
+    def __init__(self, tagname, app_models, cache_timeout=None):
+        self.tagname = tagname
+        self.app_models = app_models
+        self.cache_timeout = cache_timeout
+        self._content_types = None
+
+    def get_content_types(self):
+        if self._content_types is None:
+            self._content_types = _get_content_types(self.tagname,
+                                                     self.app_models)
+        return self._content_types
+
+    def get_cached(self, func, *args):
+        """
+        Result of func, kept in the cache for cache_timeout seconds if given.
+        The key includes the comments versions of the content types, so that
+        any new or changed comment invalidates it.
+        """
+        if not self.cache_timeout:
+            return func()
+        ct_versions = [(ct.pk, get_comments_version(ct.pk))
+                       for ct in self.get_content_types()]
+        key = "_xtd_tag_%s_%s_" % (self.tagname, md5(
+            repr((ct_versions, args))).hexdigest())
+        result = cache.get(key)
+        if result is None:
+            result = func()
+            cache.set(key, result, self.cache_timeout)
+        return result
+
+
+class XtdCommentCountNode(BaseXtdCommentsNode):
     """Store the number of XtdComments for the given list of app.models"""
 
-    def __init__(self, as_varname, content_types):
-        """Class method to parse get_xtdcomment_list and return a Node."""
+    def __init__(self, as_varname, tagname, app_models, cache_timeout=None):
+        super(XtdCommentCountNode, self).__init__(tagname, app_models,
+                                                  cache_timeout)
         self.as_varname = as_varname
-        self.qs = XtdComment.objects.for_content_types(content_types)
 
     def render(self, context):
-        context[self.as_varname] = self.qs.count()
+        context[self.as_varname] = self.get_cached(
+            lambda: XtdComment.objects.for_content_types(
+                self.get_content_types()).count())
         return ''
 
 
@@ -44,8 +85,13 @@ def get_xtdcomment_count(parser, token):
 
         {% get_xtdcomment_count as comments_count for blog.story blog.quote %}
 
+    With ``cache [seconds]`` at the end the count is kept in the cache until
+    a comment to any of the app.models is posted or changed::
+
+        {% get_xtdcomment_count as comments_count for blog.story cache 60 %}
+
     """
-    tokens = token.contents.split()
+    tokens, cache_timeout = _parse_cache_clause(token.contents.split())
 
     if tokens[1] != 'as':
         raise TemplateSyntaxError("2nd. argument in %r tag must be 'for'" % tokens[0])
@@ -55,82 +101,105 @@ def get_xtdcomment_count(parser, token):
     if tokens[3] != 'for':
         raise TemplateSyntaxError("4th. argument in %r tag must be 'for'" % tokens[0])
 
-    content_types = _get_content_types(tokens[0], tokens[4:])
-    return XtdCommentCountNode(as_varname, content_types)
+    app_models = _check_app_models(tokens[0], tokens[4:])
+    return XtdCommentCountNode(as_varname, tokens[0], app_models,
+                               cache_timeout)
 
 
-class BaseLastXtdCommentsNode(Node):
-    """Base class to deal with the last N XtdComments for a list of app.model"""
+class BaseLastXtdCommentsNode(BaseXtdCommentsNode):
+    """
+    Base class to deal with the last N XtdComments for a list of app.model.
+    Nodes are shared between threads: render must not change them.
+    """
 
-    def __init__(self, count, content_types, template_path=None):
+    def __init__(self, count, tagname, app_models, template_path=None,
+                 batch=False, cache_timeout=None):
         """Class method to parse get_xtdcomment_list and return a Node."""
+        super(BaseLastXtdCommentsNode, self).__init__(tagname, app_models,
+                                                      cache_timeout)
         try:
             self.count = int(count)
         except:
             self.count = Variable(count)
 
-        self.content_types = content_types
         self.template_path = template_path
+        self.batch = batch
+
+    def get_count(self, context):
+        if isinstance(self.count, int):
+            return self.count
+        return int(self.count.resolve(context))
+
+    def get_comments(self, count):
+        """The last count comments, with all they need to be rendered."""
+        return XtdComment.objects.for_display(
+            XtdComment.objects.for_content_types(
+                self.get_content_types())[:count])
 
 
 class RenderLastXtdCommentsNode(BaseLastXtdCommentsNode):
 
     def render(self, context):
-        if not isinstance(self.count, int):
-            self.count = int( self.count.resolve(context) )
-
-        self.qs = XtdComment.objects.for_content_types(self.content_types)[:self.count]
-
-        strlist = []
-        for xtd_comment in self.qs:
-            if self.template_path:
-                template_arg = self.template_path
-            else:
-                template_arg = [
-                    "django_comments_xtd/%s/%s/comment.html" % (
-                        xtd_comment.content_type.app_label, 
-                        xtd_comment.content_type.model),
-                    "django_comments_xtd/%s/comment.html" % (
-                        xtd_comment.content_type.app_label,),
-                    "django_comments_xtd/comment.html"
-                ]
-            strlist.append(
-                loader.render_to_string(
-                    template_arg, {"comment": xtd_comment}, context))
-        return ''.join(strlist)
+        comments = self.get_comments(self.get_count(context))
+        return render_comments(comments, context, self.template_path,
+                               batch=self.batch)
 
 
 class GetLastXtdCommentsNode(BaseLastXtdCommentsNode):
 
-    def __init__(self, count, as_varname, content_types):
-        super(GetLastXtdCommentsNode, self).__init__(count, content_types)
+    def __init__(self, count, as_varname, tagname, app_models,
+                 cache_timeout=None):
+        super(GetLastXtdCommentsNode, self).__init__(
+            count, tagname, app_models, cache_timeout=cache_timeout)
         self.as_varname = as_varname
 
     def render(self, context):
-        if not isinstance(self.count, int):
-            self.count = int( self.count.resolve(context) )
-
-        self.qs = XtdComment.objects.for_content_types(self.content_types)[:self.count]
-        context[self.as_varname] = self.qs
+        count = self.get_count(context)
+        if not self.cache_timeout:
+            context[self.as_varname] = self.get_comments(count)
+            return ''
+        # Only the ids go to the cache: the comments carry their users,
+        # password hash and email included.
+        loaded = []
+        def get_ids():
+            loaded.extend(self.get_comments(count))
+            return [comment.pk for comment in loaded]
+        ids = self.get_cached(get_ids, count)
+        if not loaded and ids:
+            comments = dict((comment.pk, comment) for comment in
+                            XtdComment.objects.for_display(
+                                XtdComment.objects.filter(pk__in=ids)))
+            loaded = [comments[pk] for pk in ids if pk in comments]
+        context[self.as_varname] = loaded
         return ''
         
 
-def _get_content_types(tagname, tokens):
-    content_types = []
-    for token in tokens:
+def _parse_cache_clause(tokens):
+    """Strip a trailing ``cache [seconds]`` from tokens."""
+    if len(tokens) > 2 and tokens[-2] == 'cache':
         try:
-            app, model = token.split('.')
-            content_types.append(
-                ContentType.objects.get(app_label=app, model=model))
+            return tokens[:-2], int(tokens[-1])
         except ValueError:
+            raise TemplateSyntaxError(
+                "'cache' in %r tag must be followed by a number of seconds" %
+                tokens[0])
+    return tokens, None
+
+
+def _check_app_models(tagname, tokens):
+    for token in tokens:
+        if len(token.split('.')) != 2:
             raise TemplateSyntaxError(
                 "Argument %s in %r must be in the format 'app.model'" % (
                     token, tagname))
-        except ContentType.DoesNotExist:
-            raise TemplateSyntaxError(
-                "%r tag has non-existant content-type: '%s.%s'" % (
-                    tagname, app, model))
-    return content_types
+    return tokens
+
+
+def _get_content_types(tagname, tokens):
+    try:
+        return get_content_types(tokens)
+    except ContentType.DoesNotExist, e:
+        raise TemplateSyntaxError("%r tag: %s" % (tagname, e))
 
 
 def render_last_xtdcomments(parser, token):
@@ -140,15 +209,25 @@ def render_last_xtdcomments(parser, token):
 
     Syntax::
 
-        {% render_last_xtdcomments [N] for [app].[model] [[app].[model]] using [template] %}
+        {% render_last_xtdcomments [N] for [app].[model] [[app].[model]] using [template] [batch] %}
 
     Example usage::
 
         {% render_last_xtdcomments 5 for blog.story blog.quote using "comments/blog/comment.html" %}
 
+    With ``batch`` the comments are rendered in one pass through the
+    ``comments_xtd/comment_batch.html`` template, or the one given with 
+    ``using``::
+
+        {% render_last_xtdcomments 5 for blog.story batch %}
+
     """
     tokens = token.contents.split()
 
+    batch = tokens[-1] == 'batch'
+    if batch:
+        tokens = tokens[:-1]
+
     try:
         count = tokens[1]
     except ValueError:
@@ -161,17 +240,18 @@ def render_last_xtdcomments(parser, token):
 
     try:
         token_using = tokens.index("using")
-        content_types = _get_content_types(tokens[0], tokens[3:token_using])
+        app_models = _check_app_models(tokens[0], tokens[3:token_using])
         try:
             template = tokens[token_using+1].strip('" ')
         except IndexError:
             raise TemplateSyntaxError(
                 "Last argument in %r tag must be a relative template path" % tokens[0])       
     except ValueError:
-        content_types = _get_content_types(tokens[0], tokens[3:])
+        app_models = _check_app_models(tokens[0], tokens[3:])
         template = None
 
-    return RenderLastXtdCommentsNode(count, content_types, template)
+    return RenderLastXtdCommentsNode(count, tokens[0], app_models, template,
+                                     batch)
 
 
 def get_last_xtdcomments(parser, token):
@@ -180,20 +260,23 @@ def get_last_xtdcomments(parser, token):
 
     Syntax::
 
-        {% get_last_xtdcomments [N] as [varname] for [app].[model] [[app].[model]] %}
+        {% get_last_xtdcomments [N|varname] as [varname] for [app].[model] [[app].[model]] %}
 
     Example usage::
 
         {% get_last_xtdcomments 5 as last_comments for blog.story blog.quote %}
 
+    With ``cache [seconds]`` at the end the ids of the comments are kept in
+    the cache until a comment to any of the app.models is posted or changed,
+    and the comments are loaded by their primary key::
+
+        {% get_last_xtdcomments 5 as last_comments for blog.story cache 60 %}
+
     """
-    tokens = token.contents.split()
+    tokens, cache_timeout = _parse_cache_clause(token.contents.split())
 
-    try:
-        count = int(tokens[1])
-    except ValueError:
-        raise TemplateSyntaxError(
-            "Second argument in %r tag must be a integer" % tokens[0])
+    # an integer, or a context variable resolved on every render
+    count = tokens[1]
 
     if tokens[2] != 'as':
         raise TemplateSyntaxError(
@@ -205,8 +288,124 @@ def get_last_xtdcomments(parser, token):
         raise TemplateSyntaxError(
             "Fifth argument in %r tag must be 'for'" % tokens[0])
 
-    content_types = _get_content_types(tokens[0], tokens[5:])
-    return GetLastXtdCommentsNode(count, as_varname, content_types)
+    app_models = _check_app_models(tokens[0], tokens[5:])
+    return GetLastXtdCommentsNode(count, as_varname, tokens[0], app_models,
+                                  cache_timeout)
+
+
+class RenderXtdCommentTreeNode(Node):
+
+    def __init__(self, obj, template_path=None, max_depth=None,
+                 max_children=None):
+        self.obj = Variable(obj)
+        self.template_path = template_path
+        self.max_depth = max_depth
+        self.max_children = max_children
+
+    def render(self, context):
+        obj = self.obj.resolve(context)
+        tree = XtdComment.objects.tree_for_object(
+            ContentType.objects.get_for_model(obj), obj.pk,
+            max_depth=self.max_depth, max_children=self.max_children)
+        return render_comment_tree(tree, context, self.template_path,
+                                   max_depth=self.max_depth,
+                                   max_children=self.max_children)
+
+
+def render_xtdcomment_tree(parser, token):
+    """
+    Render the threaded comments to the given object as nested lists, each
+    comment through the ``comments_xtd/comment.html`` template
+
+    Syntax::
+
+        {% render_xtdcomment_tree for [object] [using [template]] [depth [K]] [children [M]] %}
+
+    Example usage::
+
+        {% render_xtdcomment_tree for story using "comments/blog/comment.html" %}
+
+    With ``depth`` only the top K levels are rendered, and with ``children``
+    only the first M replies to each comment and the first M top level
+    comments. Left out comments are replaced with links to the
+    ``comments-xtd-replies`` and ``comments-xtd-tree-for-object`` views. 
+    They default to the settings COMMENTS_XTD_TREE_MAX_DEPTH and
+    COMMENTS_XTD_TREE_MAX_CHILDREN::
+
+        {% render_xtdcomment_tree for story depth 3 children 10 %}
+
+    """
+    tokens = token.contents.split()
+
+    if len(tokens) < 3 or tokens[1] != 'for':
+        raise TemplateSyntaxError(
+            "Second argument in %r tag must be 'for'" % tokens[0])
+
+    options = {'using': None, 'depth': TREE_MAX_DEPTH,
+               'children': TREE_MAX_CHILDREN}
+    args = tokens[3:]
+    if len(args) % 2:
+        raise TemplateSyntaxError(
+            "Options in %r tag must be 'using', 'depth' or 'children' "
+            "followed by a value" % tokens[0])
+    for name, value in zip(args[::2], args[1::2]):
+        if name == 'using':
+            options[name] = value.strip('" ')
+        elif name in ('depth', 'children'):
+            try:
+                options[name] = int(value)
+                if options[name] < 1:
+                    raise ValueError("Bad %s" % name)
+            except ValueError:
+                raise TemplateSyntaxError(
+                    "%r in %r tag must be followed by a number" % (
+                        name, tokens[0]))
+        else:
+            raise TemplateSyntaxError(
+                "Unknown option %r in %r tag" % (name, tokens[0]))
+
+    return RenderXtdCommentTreeNode(tokens[2], options['using'],
+                                    options['depth'], options['children'])
+
+
+class RenderXtdCommentNode(Node):
+
+    def __init__(self, comment):
+        self.comment = Variable(comment)
+
+    def render(self, context):
+        comment = self.comment.resolve(context)
+        template = get_comment_template(
+            ContentType.objects.get_for_id(comment.content_type_id))
+        context.push()
+        context["comment"] = comment
+        output = template.render(context)
+        context.pop()
+        return output
+
+
+def render_xtdcomment(parser, token):
+    """
+    Render a comment through the ``comments_xtd/comment.html`` template of
+    its app and model, compiled once. Meant for list templates, like
+    ``comments_xtd/comment_batch.html``.
+
+    Syntax::
+
+        {% render_xtdcomment [comment] %}
+
+    Example usage::
+
+        {% for comment in comment_list %}{% render_xtdcomment comment %}{% endfor %}
+
+    """
+    tokens = token.contents.split()
+    if len(tokens) != 2:
+        raise TemplateSyntaxError("%r tag takes one argument" % tokens[0])
+    return RenderXtdCommentNode(tokens[1])
+
+
+_markup_cache = LRUCache(MARKUP_CACHE_SIZE)
 
 
 def render_markup_comment(value):
@@ -226,26 +425,30 @@ def render_markup_comment(value):
     Would be rendered as a markdown text, producing the output::
 
         <p><a href="http://url.com/" title="Title">example</a></p>
+
+    Applied to the comment itself, ``{{ comment|render_markup_comment }}``,
+    it returns the HTML stored in ``comment.comment_html`` when saved.
+    Other values are rendered once and kept in a bounded cache.
     """
-    lines = value.splitlines()
-    rawstr = r"""^#!(?P<markup_filter>\w+)$"""
-    match_obj = re.search(rawstr, lines[0])
-    if match_obj:
-        markup_filter = match_obj.group('markup_filter')
+    if isinstance(value, XtdComment):
+        if value.comment_html:
+            return mark_safe(value.comment_html)
+        value = value.comment
+    output = _markup_cache.get(value)
+    if output is None:
         try:
-            if formatter:
-                return mark_safe(formatter("\n".join(lines[1:]), filter_name=markup_filter))
-            else:
-                raise TemplateSyntaxError(
-                    "In order to use this templatetag you need django-markup, docutils and markdown installed")
-        except ValueError, e:
-            output = "<p>Warning: %s</p>" % e
-            return output + value
-    else:
-        return value
+            output = render_markup(value)
+        except MarkupNotAvailable, e:
+            raise TemplateSyntaxError(str(e))
+        if output is None:
+            return value
+        _markup_cache.set(value, output)
+    return mark_safe(output)
 
 
 register.tag(get_xtdcomment_count)
 register.tag(render_last_xtdcomments)
 register.tag(get_last_xtdcomments)
+register.tag(render_xtdcomment_tree)
+register.tag(render_xtdcomment)
 register.filter(render_markup_comment)
@@ -2,12 +2,16 @@ import unittest
 
 
 def suite():
-    from django_comments_xtd.tests import forms, models, templatetags, views
+    from django_comments_xtd.tests import (commands, forms, models, signed,
+                                          stream, templatetags, views)
 
     testsuite = unittest.TestSuite([
         unittest.TestLoader().loadTestsFromModule(models),
         unittest.TestLoader().loadTestsFromModule(forms),
         unittest.TestLoader().loadTestsFromModule(views),
+        unittest.TestLoader().loadTestsFromModule(signed),
+        unittest.TestLoader().loadTestsFromModule(stream),
         unittest.TestLoader().loadTestsFromModule(templatetags),
+        unittest.TestLoader().loadTestsFromModule(commands),
     ])
     return testsuite
@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase as DjangoTestCase
+
+from django_comments_xtd.models import XtdComment
+from django_comments_xtd.tests.models import Article
+from django_comments_xtd.utils import get_comments_version
+
+
+class CommandBaseTestCase(DjangoTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        self.article_ct = ContentType.objects.get(app_label="tests",
+                                                  model="article")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def post_comment(self, text):
+        return XtdComment.objects.create(
+            content_type=self.article_ct, object_pk=self.article.id,
+            content_object=self.article, site_id=1, comment=text,
+            submit_date=datetime.now())
+
+
+class ExportCommentsTestCase(CommandBaseTestCase):
+    def export(self, **options):
+        output = os.path.join(self.tmpdir, "comments.jsonl")
+        call_command("xtd_export_comments", output=output, **options)
+        with open(output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_export_in_chunks(self):
+        for i in range(5):
+            self.post_comment("comment %d" % i)
+        rows = self.export(chunk_size=2, content_types=["tests.article"])
+        self.assertEqual([row["comment"] for row in rows],
+                         ["comment %d" % i for i in range(5)])
+        self.assertEqual(rows[0]["content_type"], "tests.article")
+
+    def test_export_from_high_water_mark(self):
+        state_file = os.path.join(self.tmpdir, "state")
+        self.post_comment("first")
+        self.assertEqual(len(self.export(state_file=state_file)), 1)
+        self.assertEqual(self.export(state_file=state_file), [])
+        self.post_comment("second")
+        rows = self.export(state_file=state_file)
+        self.assertEqual([row["comment"] for row in rows], ["second"])
+
+
+class RerenderMarkupTestCase(CommandBaseTestCase):
+    def rerender(self, **options):
+        call_command("xtd_rerender_markup", processes=1, chunk_size=2,
+                     verbosity=0, **options)
+
+    def test_rerender_updates_stale_html(self):
+        for i in range(5):
+            self.post_comment("comment %d" % i)
+        XtdComment.objects.update(comment_html="stale")
+        version = get_comments_version(self.article_ct.pk, self.article.id)
+        self.rerender()
+        self.assertEqual(
+            list(XtdComment.objects.values_list('comment_html', flat=True)),
+            [""] * 5)
+        self.assertNotEqual(
+            get_comments_version(self.article_ct.pk, self.article.id),
+            version)
+
+    def test_rerender_resumes_from_checkpoint(self):
+        comments = [self.post_comment("comment %d" % i) for i in range(5)]
+        XtdComment.objects.update(comment_html="stale")
+        checkpoint = os.path.join(self.tmpdir, "checkpoint")
+        with open(checkpoint, "w") as f:
+            f.write("%d\n" % comments[3].pk)
+        self.rerender(checkpoint=checkpoint)
+        self.assertEqual(
+            list(XtdComment.objects.order_by('pk').values_list(
+                'comment_html', flat=True)),
+            ["stale"] * 3 + [""] * 2)
+        self.assertFalse(os.path.exists(checkpoint))
@@ -2,11 +2,20 @@ from datetime import datetime
 
 from django.db import models
 from django.db.models import permalink
+from django.contrib import admin as django_admin
+from django.contrib.auth.models import User
+from django.contrib.comments.models import Comment, CommentFlag
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.test import TestCase as DjangoTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
+from django_comments_xtd import admin, signals
+from django_comments_xtd.admin import EstimatedCountQuerySet
 from django_comments_xtd.models import XtdComment, MaxThreadLevelExceededException
+from django_comments_xtd.utils import get_comments_version, get_content_types
 
 
 class PublicManager(models.Manager):
@@ -55,6 +64,19 @@ class Diary(models.Model):
         ordering = ('-publish',)
 
 
+class NotifiedComment(XtdComment):
+    """XtdComment with a notification context that only reads the models
+    of the tests."""
+
+    class Meta:
+        proxy = True
+
+    def get_test_context(self):
+        return {'userName': self.user.username,
+                'model': self.content_type.model,
+                'body': self.content_object.body}
+
+
 class ArticleBaseTestCase(DjangoTestCase):
     def setUp(self):
         self.article_1 = Article.objects.create(
@@ -104,6 +126,111 @@ class XtdCommentManagerTestCase(ArticleBaseTestCase):
         count = XtdComment.objects.for_app_models("tests.article").count()
         self.assert_(count == 3)
 
+    def test_comments_since(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        comments = []
+        for article in [self.article_1, self.article_2, self.article_1]:
+            comments.append(XtdComment.objects.create(
+                content_type=article_ct, object_pk=article.id,
+                content_object=article, site_id=1,
+                comment="comment to %s" % article.title,
+                submit_date=datetime.now()))
+        qs = XtdComment.objects.comments_since(article_ct, self.article_1.id)
+        self.assertEqual(list(qs), [comments[0], comments[2]])
+        qs = XtdComment.objects.comments_since(article_ct, self.article_1.id,
+                                               after_id=comments[0].id)
+        self.assertEqual(list(qs), [comments[2]])
+        qs = XtdComment.objects.comments_since(article_ct, self.article_1.id,
+                                               after_id=comments[2].id)
+        self.assertEqual(list(qs), [])
+
+    def test_moderate(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        for article in [self.article_1, self.article_2, self.article_1]:
+            XtdComment.objects.create(content_type=article_ct,
+                                      object_pk=article.id,
+                                      content_object=article, site_id=1,
+                                      comment="spam",
+                                      submit_date=datetime.now())
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+        signals.comments_moderated.connect(receiver)
+        try:
+            count = XtdComment.objects.moderate(
+                XtdComment.objects.all(), CommentFlag.MODERATOR_DELETION,
+                user)
+            XtdComment.objects.moderate(
+                XtdComment.objects.all(), CommentFlag.MODERATOR_DELETION,
+                user)
+        finally:
+            signals.comments_moderated.disconnect(receiver)
+        self.assertEqual(count, 3)
+        self.assertEqual(XtdComment.objects.filter(is_removed=True).count(), 3)
+        self.assertEqual(CommentFlag.objects.filter(
+            flag=CommentFlag.MODERATOR_DELETION).count(), 3)
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[0]["objects"],
+                         set([(article_ct.id, unicode(self.article_1.id)),
+                              (article_ct.id, unicode(self.article_2.id))]))
+
+        XtdComment.objects.moderate(
+            XtdComment.objects.filter(object_pk=self.article_2.id),
+            CommentFlag.MODERATOR_APPROVAL, user)
+        self.assertEqual(
+            list(XtdComment.objects.filter(is_removed=False).values_list(
+                'object_pk', flat=True)), [unicode(self.article_2.id)])
+
+    def test_for_app_models_resolves_labels_once(self):
+        XtdComment.objects.for_app_models("tests.article", "tests.diary")
+        with self.assertNumQueries(0):
+            article_ct, diary_ct = get_content_types(["tests.article",
+                                                      "tests.diary"])
+        self.assertEqual(article_ct, ContentType.objects.get_for_model(Article))
+        self.assertEqual(diary_ct, ContentType.objects.get_for_model(Diary))
+        self.assertRaises(ContentType.DoesNotExist,
+                          get_content_types, ["tests.unknown"])
+        with self.assertNumQueries(0):
+            self.assertRaises(ContentType.DoesNotExist,
+                              get_content_types, ["tests.unknown"])
+        self.assertRaises(ValueError, get_content_types, ["tests"])
+        # a stale row, with no model, like those left by removed apps
+        unknown_ct = ContentType.objects.create(app_label="tests",
+                                                model="unknown")
+        self.assertEqual(get_content_types(["tests.unknown"]), [unknown_ct])
+        unknown_ct.delete() # clears the cache too
+
+    def test_for_display_query_count(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        diary_ct = ContentType.objects.get(app_label="tests", model="diary")
+        diary = Diary.objects.create(body="About Today...")
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        # warm up the content type cache
+        ContentType.objects.get_for_id(article_ct.id)
+        ContentType.objects.get_for_id(diary_ct.id)
+
+        total = 0
+        for count in [1, 4]:
+            total += count * 2
+            for i in range(count):
+                for ct, obj in [(article_ct, self.article_1),
+                                (diary_ct, diary)]:
+                    XtdComment.objects.create(
+                        content_type=ct, object_pk=obj.id,
+                        content_object=obj, site_id=1, user=user,
+                        comment="comment %d" % i,
+                        submit_date=datetime.now())
+            # one query for the comments, one per content type
+            with self.assertNumQueries(3):
+                comments = XtdComment.objects.for_display()
+                for comment in comments:
+                    comment.user.email
+                    comment.content_type.model
+                    comment.site.domain
+                    comment.content_object.body
+            self.assertEqual(len(comments), total)
+
 # In order to methods save and test _calculate_thread_ata, simulate the 
 # following threads, in order of arrival:
 #
@@ -398,6 +525,176 @@ class ThreadStep5TestCase(ArticleBaseTestCase):
         self.assert_(self.c8.parent_id == 3 and  self.c8.thread_id == 1)
         self.assert_(self.c8.level == 2 and self.c8.order == 3)
 
+    def test_page_for_object(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        page_for_object = XtdComment.objects.page_for_object
+        comments, cursor = page_for_object(article_ct, self.article_1.id,
+                                           page_size=4)
+        self.assertEqual(comments, [self.c1, self.c3, self.c8, self.c4])
+        self.assertEqual(cursor, (1, 4))
+        comments, cursor = page_for_object(article_ct, self.article_1.id,
+                                           after=cursor, page_size=4)
+        self.assertEqual(comments, [self.c7, self.c2, self.c5, self.c6])
+        self.assertEqual(cursor, (2, 3))
+        comments, cursor = page_for_object(article_ct, self.article_1.id,
+                                           after=cursor, page_size=4)
+        self.assertEqual(comments, [self.c9])
+        self.assert_(cursor is None)
+
+    def test_tree_for_object(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        tree = XtdComment.objects.tree_for_object(article_ct,
+                                                  self.article_1.id)
+        def shape(nodes):
+            return [(node['comment'], shape(node['children']))
+                    for node in nodes]
+        self.assertEqual(shape(tree), [
+            (self.c1, [(self.c3, [(self.c8, [])]),
+                       (self.c4, [(self.c7, [])])]),
+            (self.c2, [(self.c5, [(self.c6, [])])]),
+            (self.c9, []),
+        ])
+
+    def test_tree_for_object_leaves_out_replies_to_non_public(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        XtdComment.objects.filter(pk=self.c4.pk).update(is_public=False)
+        tree = XtdComment.objects.tree_for_object(article_ct,
+                                                  self.article_1.id)
+        def shape(nodes):
+            return [(node['comment'], shape(node['children']))
+                    for node in nodes]
+        # c7, reply to c4, is not nested under c3
+        self.assertEqual(shape(tree), [
+            (self.c1, [(self.c3, [(self.c8, [])])]),
+            (self.c2, [(self.c5, [(self.c6, [])])]),
+            (self.c9, []),
+        ])
+
+    def test_tree_for_object_collapsed(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        def shape(nodes):
+            return [(node['comment'], node.get('more', 0),
+                     shape(node['children'])) for node in nodes]
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, max_depth=2)
+        self.assertEqual(shape(tree), [
+            (self.c1, 0, [(self.c3, 1, []), (self.c4, 1, [])]),
+            (self.c2, 0, [(self.c5, 1, [])]),
+            (self.c9, 0, []),
+        ])
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, root=self.c1)
+        self.assertEqual(shape(tree), [
+            (self.c3, 0, [(self.c8, 0, [])]),
+            (self.c4, 0, [(self.c7, 0, [])]),
+        ])
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, root=self.c2, max_depth=1)
+        self.assertEqual(shape(tree), [(self.c5, 1, [])])
+
+    def test_tree_for_object_limits_children_in_sql(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        def shape(nodes):
+            return [(node['comment'], node.get('more', 0),
+                     shape(node['children'])) for node in nodes]
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, max_children=1)
+        self.assertEqual(shape(tree), [
+            (self.c1, 1, [(self.c3, 0, [(self.c8, 0, [])])]),
+        ])
+        self.assertEqual(tree.more, 2)
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, max_children=1, skip=1)
+        self.assertEqual(shape(tree), [
+            (self.c2, 0, [(self.c5, 0, [(self.c6, 0, [])])]),
+        ])
+        self.assertEqual(tree.more, 1)
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, root=self.c1, max_depth=1,
+            max_children=1)
+        self.assertEqual(shape(tree), [(self.c3, 1, [])])
+        self.assertEqual(tree.more, 1)
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, root=self.c1, max_children=1,
+            skip=1)
+        self.assertEqual(shape(tree), [(self.c4, 0, [(self.c7, 0, [])])])
+        self.assertEqual(tree.more, 0)
+
+    def test_tree_for_object_limits_children_of_public_comments(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        XtdComment.objects.filter(pk=self.c3.pk).update(is_public=False)
+        def shape(nodes):
+            return [(node['comment'], node.get('more', 0),
+                     shape(node['children'])) for node in nodes]
+        tree = XtdComment.objects.tree_for_object(
+            article_ct, self.article_1.id, max_children=1)
+        self.assertEqual(shape(tree), [
+            (self.c1, 0, [(self.c4, 0, [(self.c7, 0, [])])]),
+        ])
+
+    def test_delete_subtree(self):
+        user = User.objects.create_user("bob", "bob@example.com", "pwd")
+        for comment in (self.c3, self.c8, self.c4):
+            CommentFlag.objects.create(comment=comment, user=user,
+                                       flag=CommentFlag.SUGGEST_REMOVAL)
+        cache.set_many({"_comment_dict_%d_" % self.c8.pk: {},
+                        "_num_likes_for_comment_%d_" % self.c8.pk: 1,
+                        "_comment_dict_%d_" % self.c4.pk: {}})
+        version = get_comments_version(self.c3.content_type_id,
+                                       self.c3.object_pk)
+        count = XtdComment.objects.delete_subtree(self.c3)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            list(XtdComment.objects.filter(thread_id=1).values_list(
+                'id', 'order')), [(1, 1), (4, 4), (7, 5)])
+        self.assertEqual(XtdComment.objects.count(), 7)
+        self.assertEqual(Comment.objects.count(), 7)
+        self.assertEqual(
+            list(CommentFlag.objects.values_list('comment_id', flat=True)),
+            [self.c4.pk])
+        self.assertNotEqual(get_comments_version(self.c3.content_type_id,
+                                                 self.c3.object_pk), version)
+        self.assertEqual(cache.get("_comment_dict_%d_" % self.c8.pk), None)
+        self.assertEqual(
+            cache.get("_num_likes_for_comment_%d_" % self.c8.pk), None)
+        self.assertEqual(cache.get("_comment_dict_%d_" % self.c4.pk), {})
+        cache.clear()
+
+    def test_delete_subtree_reads_the_range_from_the_database(self):
+        # c3 as loaded before c1 got a reply that moved it down the thread
+        stale = XtdComment.objects.get(pk=self.c3.pk)
+        stale.order -= 1
+        self.assertEqual(XtdComment.objects.delete_subtree(stale), 2)
+        self.assertEqual(
+            list(XtdComment.objects.filter(thread_id=1).values_list(
+                'id', flat=True)), [1, 4, 7])
+
+    def test_delete_subtree_compact(self):
+        self.assertEqual(XtdComment.objects.delete_subtree(self.c3,
+                                                           compact=True), 2)
+        self.assertEqual(
+            list(XtdComment.objects.filter(thread_id=1).values_list(
+                'id', 'order')), [(1, 1), (4, 2), (7, 3)])
+        self.assertEqual(XtdComment.objects.delete_subtree(self.c2,
+                                                           compact=True), 3)
+        self.assertEqual(
+            list(XtdComment.objects.values_list('id', flat=True)),
+            [1, 4, 7, 9])
+
+    def test_page_for_object_whole_threads(self):
+        article_ct = ContentType.objects.get(app_label="tests", model="article")
+        page_for_object = XtdComment.objects.page_for_object
+        comments, cursor = page_for_object(article_ct, self.article_1.id,
+                                           page_size=2, whole_threads=True)
+        self.assertEqual(comments, [self.c1, self.c3, self.c8, self.c4,
+                                    self.c7, self.c2, self.c5, self.c6])
+        self.assertEqual(cursor, (2, 3))
+        comments, cursor = page_for_object(article_ct, self.article_1.id,
+                                           after=cursor, page_size=2,
+                                           whole_threads=True)
+        self.assertEqual(comments, [self.c9])
+        self.assert_(cursor is None)
+
     def test_exceed_max_thread_level_raises_exception(self):
         article_ct = ContentType.objects.get(app_label="tests", model="article")
         site = Site.objects.get(pk=1)
@@ -435,3 +732,143 @@ class DiaryBaseTestCase(DjangoTestCase):
                                       submit_date    = datetime.now(),
                                       parent_id      = 1) # already max thread level
         
+
+
+class AdminBaseTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super(AdminBaseTestCase, self).setUp()
+        self.comments = [
+            XtdComment.objects.create(content_object=article, site_id=1,
+                                      comment="comment",
+                                      submit_date=datetime.now())
+            for article in [self.article_1, self.article_2,
+                            self.article_1, self.article_2]]
+        self.qs = XtdComment.objects.all()._clone(
+            klass=EstimatedCountQuerySet)
+        self.estimated_count = admin.estimated_count
+
+    def tearDown(self):
+        admin.estimated_count = self.estimated_count
+
+
+class EstimatedCountQuerySetTestCase(AdminBaseTestCase):
+    def test_count_without_planner_statistics_is_exact(self):
+        # the test database, SQLite, keeps no row estimates
+        self.assertEqual(self.qs.count(), 4)
+        self.assertEqual(
+            self.qs.filter(object_pk=self.article_1.id).count(), 2)
+        self.assertEqual(self.qs.filter(id__lt=self.comments[2].pk).count(), 2)
+
+    def test_count_of_large_tables_is_estimated(self):
+        admin.estimated_count = lambda model, using: 1000000
+        self.assertEqual(self.qs.count(), 1000000)
+        # the pk range of the keyset navigation is estimated too
+        self.assertEqual(
+            self.qs.filter(id__lt=str(self.comments[2].pk)).count(), 500000)
+        self.assertEqual(
+            self.qs.filter(id__gte=self.comments[1].pk).filter(
+                id__lte=self.comments[1].pk).count(), 250000)
+        self.assertEqual(self.qs.filter(id__gt=self.comments[3].pk).count(), 0)
+        # any other filter is counted
+        self.assertEqual(
+            self.qs.filter(object_pk=self.article_1.id).count(), 2)
+        self.assertEqual(
+            self.qs.filter(id__lt=self.comments[2].pk).filter(
+                object_pk=self.article_1.id).count(), 1)
+        self.assertEqual(
+            self.qs.exclude(id__lt=self.comments[2].pk).count(), 2)
+
+    def test_count_of_small_tables_is_exact(self):
+        admin.estimated_count = lambda model, using: 10
+        self.assertEqual(self.qs.count(), 4)
+
+
+class XtdCommentsPerformanceAdminTestCase(AdminBaseTestCase):
+    def setUp(self):
+        super(XtdCommentsPerformanceAdminTestCase, self).setUp()
+        self.model_admin = admin.XtdCommentsPerformanceAdmin(
+            XtdComment, django_admin.site)
+        self.model_admin.list_per_page = 3
+
+    def get_changelist(self, params):
+        request = RequestFactory().get('/', params)
+        model_admin = self.model_admin
+        ChangeList = model_admin.get_changelist(request)
+        return ChangeList(request, XtdComment, model_admin.list_display,
+                          model_admin.list_display_links,
+                          model_admin.list_filter, model_admin.date_hierarchy,
+                          model_admin.search_fields,
+                          model_admin.list_select_related,
+                          model_admin.list_per_page,
+                          model_admin.list_max_show_all,
+                          model_admin.list_editable, model_admin)
+
+    def test_config(self):
+        self.assertEqual(self.model_admin.date_hierarchy, None)
+        self.assertEqual(self.model_admin.ordering, ('-id',))
+        self.assertEqual(self.model_admin.raw_id_fields,
+                         ('content_type', 'user'))
+        self.assertTrue(isinstance(self.model_admin.queryset(None),
+                                   EstimatedCountQuerySet))
+
+    def test_older_comments_url(self):
+        admin.estimated_count = lambda model, using: 1000000
+        cl = self.get_changelist({})
+        self.assertEqual(list(cl.result_list), self.comments[:0:-1])
+        self.assertEqual(cl.result_count, 1000000)
+        url = admin.older_comments_url(cl)
+        self.assertEqual(url, '?id__lt=%d' % self.comments[1].pk)
+        cl = self.get_changelist({'id__lt': self.comments[1].pk})
+        self.assertEqual(list(cl.result_list), self.comments[:1])
+        self.assertEqual(cl.result_count, 250000)
+        # last page
+        self.assertEqual(admin.older_comments_url(cl), None)
+        # sorted by another column
+        cl = self.get_changelist({'o': '2'})
+        self.assertEqual(admin.older_comments_url(cl), None)
+
+
+MOB_TYPES = {'test': dict((n, {'ios': 'IOS_%d' % n, 'android': 'ANDROID_%d' % n})
+                          for n in range(5))}
+
+
+@override_settings(MOB_TYPES=MOB_TYPES)
+class NotificationContextsTestCase(ArticleBaseTestCase):
+    def setUp(self):
+        super(NotificationContextsTestCase, self).setUp()
+        self.diary = Diary.objects.create(body="About Today...")
+        users = [User.objects.create_user(name, "%s@example.com" % name, "pwd")
+                 for name in ("alice", "bob", "carol")]
+        for i in range(6):
+            XtdComment.objects.create(
+                content_object=[self.article_1, self.diary][i % 2],
+                user=users[i % 3], site_id=1, comment="comment %d" % i,
+                submit_date=datetime.now())
+        for ctype in ContentType.objects.all():
+            ContentType.objects.get_for_id(ctype.pk) # warm up its cache
+
+    def groups(self, count):
+        comments = list(NotifiedComment.objects.order_by('pk'))
+        return [('test', [comments[i % len(comments)]])
+                for i in range(count)]
+
+    def test_queries_do_not_grow_with_groups(self):
+        # users, articles and diaries
+        for count in (1, 2, 6, 30):
+            groups = self.groups(count)
+            with self.assertNumQueries(count == 1 and 2 or 3):
+                contexts = NotifiedComment.get_notification_contexts(groups)
+            self.assertEqual(len(contexts), count)
+        self.assertEqual(contexts[:2], [
+            {'userName': 'alice', 'model': 'article', 'body': self.article_1.body,
+             'ios_type': 'IOS_1', 'android_type': 'ANDROID_1'},
+            {'userName': 'bob', 'model': 'diary', 'body': self.diary.body,
+             'ios_type': 'IOS_1', 'android_type': 'ANDROID_1'}])
+
+    def test_comments_to_deleted_objects_are_left_out(self):
+        Diary.objects.all().delete()
+        groups = self.groups(2)
+        with self.assertNumQueries(3):
+            contexts = NotifiedComment.get_notification_contexts(groups)
+        self.assertEqual(contexts[0]['model'], 'article')
+        self.assertEqual(contexts[1], None)
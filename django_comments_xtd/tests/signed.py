@@ -0,0 +1,57 @@
+#-*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from django_comments_xtd import signed
+from django_comments_xtd.models import TmpXtdComment
+from django_comments_xtd.tests.models import Article
+
+
+class CommentTokenTestCase(TestCase):
+    def setUp(self):
+        self.comment = TmpXtdComment(
+            content_type=ContentType.objects.get_for_model(Article),
+            object_pk=u"1", site_id=1, user_name=u"Bob",
+            user_email=u"bob@example.com", user_url=u"",
+            comment=u"Es war einmal eine kleine Prinzessin äöü",
+            submit_date=datetime(2012, 12, 12, 10, 20, 30, 123456),
+            ip_address="127.0.0.1", is_public=False, is_removed=False,
+            thread_id=0, parent_id=3, level=0, order=1, followup=True)
+
+    def test_dumps_comment_and_loads_comment(self):
+        for compress in (False, True):
+            key = signed.dumps_comment(self.comment, compress=compress)
+            self.assert_(key.startswith(signed.COMMENT_TOKEN_PREFIX))
+            self.assertEqual(signed.loads_comment(key), self.comment)
+
+    def tearDown(self):
+        signed.ACCEPT_PICKLED_TOKENS = False
+
+    def test_loads_comment_reads_pickled_tokens(self):
+        key = signed.dumps(self.comment, compress=True)
+        self.assertRaises(ValueError, signed.loads_comment, key)
+        signed.ACCEPT_PICKLED_TOKENS = True
+        self.assertEqual(signed.loads_comment(key), self.comment)
+
+    def test_pickled_tokens_can_not_load_other_classes(self):
+        signed.ACCEPT_PICKLED_TOKENS = True
+        key = signed.dumps(Article(title="September"))
+        self.assertRaises(ValueError, signed.loads_comment, key)
+
+    def test_decompressed_size_is_bounded(self):
+        self.comment.comment = u"a" * (signed.MAX_TOKEN_SIZE + 1)
+        key = signed.dumps_comment(self.comment, compress=True)
+        self.assertRaises(ValueError, signed.loads_comment, key)
+
+    def test_compact_token_is_shorter(self):
+        self.assert_(len(signed.dumps_comment(self.comment, compress=True)) <
+                     len(signed.dumps(self.comment, compress=True)))
+
+    def test_bad_signature(self):
+        key = signed.dumps_comment(self.comment, extra_key="salt")
+        self.assertRaises(signed.BadSignature, signed.loads_comment, key)
+        self.assertRaises(signed.BadSignature,
+                          signed.loads_comment, key[:-1], extra_key="salt")
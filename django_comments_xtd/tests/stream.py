@@ -0,0 +1,37 @@
+import threading
+import time
+import unittest
+
+from django_comments_xtd.stream import LocalBroker
+
+
+class LocalBrokerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.broker = LocalBroker()
+
+    def publish_later(self, channel, comment_id, delay=0.1):
+        timer = threading.Timer(delay, self.broker.publish,
+                                args=(channel, comment_id))
+        timer.start()
+        return timer
+
+    def test_wait_returns_when_a_comment_is_published(self):
+        self.publish_later("10:1", 5)
+        start = time.time()
+        self.assert_(self.broker.wait("10:1", 4, timeout=5))
+        self.assert_(time.time() - start < 5)
+
+    def test_wait_times_out(self):
+        self.assertFalse(self.broker.wait("10:1", 4, timeout=0.1))
+
+    def test_comments_to_other_objects_or_older_are_ignored(self):
+        self.publish_later("10:2", 5)
+        self.publish_later("10:1", 3)
+        self.assertFalse(self.broker.wait("10:1", 4, timeout=0.3))
+
+    def test_no_state_is_kept_without_waiters(self):
+        self.broker.publish("10:1", 5)
+        self.assertEqual(self.broker.waiters, {})
+        self.assertEqual(self.broker.last_ids, {})
+        self.assertFalse(self.broker.wait("10:1", 4, timeout=0.1))
+        self.assertEqual(self.broker.waiters, {})
@@ -1,11 +1,111 @@
 #-*- coding: utf-8 -*-
 
 import unittest
+from datetime import datetime
 
-from django.template import TemplateSyntaxError
+from django.contrib.contenttypes.models import ContentType
+from django.template import Context, Template, TemplateSyntaxError
 from django.test import TestCase as DjangoTestCase
 
+from django_comments_xtd.templatetags import comments_xtd as tags
 from django_comments_xtd.templatetags.comments_xtd import render_markup_comment, formatter
+from django_comments_xtd.models import XtdComment
+from django_comments_xtd.tests.models import Article
+from django_comments_xtd import utils
+from django_comments_xtd.utils import clear_content_types_cache, LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_keeps_most_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+
+class LazyContentTypesTestCase(DjangoTestCase):
+
+    def setUp(self):
+        clear_content_types_cache()
+
+    def test_parsing_issues_no_queries(self):
+        with self.assertNumQueries(0):
+            t = Template("{% load comments_xtd %}"
+                         "{% get_xtdcomment_count as count for tests.article tests.diary %}"
+                         "{{ count }}")
+        self.assertEqual(t.render(Context()), "0")
+
+    def test_unknown_content_type_fails_on_render(self):
+        t = Template("{% load comments_xtd %}"
+                     "{% get_last_xtdcomments 5 as last for tests.unknown %}")
+        self.assertRaises(TemplateSyntaxError, t.render, Context())
+
+    def test_count_with_cache_clause(self):
+        t = Template("{% load comments_xtd %}"
+                     "{% get_xtdcomment_count as count for tests.article cache 60 %}"
+                     "{{ count }}")
+        self.assertEqual(t.render(Context()), "0")
+        with self.assertNumQueries(0):
+            self.assertEqual(t.render(Context()), "0")
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        XtdComment.objects.create(
+            content_type=ContentType.objects.get_for_model(article),
+            object_pk=article.id, content_object=article, site_id=1,
+            comment="a comment", submit_date=datetime.now())
+        self.assertEqual(t.render(Context()), "1")
+
+    def test_variable_count_is_resolved_on_every_render(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        for i in range(3):
+            XtdComment.objects.create(
+                content_type=ContentType.objects.get_for_model(article),
+                object_pk=article.id, content_object=article, site_id=1,
+                comment="comment %d" % i, submit_date=datetime.now())
+        t = Template("{% load comments_xtd %}"
+                     "{% get_last_xtdcomments n as last for tests.article %}"
+                     "{{ last|length }}")
+        self.assertEqual(t.render(Context({"n": 1})), "1")
+        self.assertEqual(t.render(Context({"n": 3})), "3")
+
+    def test_last_comments_cache_keeps_ids(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        comments = [XtdComment.objects.create(
+            content_type=ContentType.objects.get_for_model(article),
+            object_pk=article.id, content_object=article, site_id=1,
+            comment="comment %d" % i, submit_date=datetime.now())
+            for i in range(3)]
+        t = Template("{% load comments_xtd %}"
+                     "{% get_last_xtdcomments 2 as last for tests.article cache 60 %}"
+                     "{% for c in last %}{{ c.comment }},{% endfor %}")
+        stored = {}
+        class RecordingCache(object):
+            def get(self, key):
+                return stored.get(key)
+            def set(self, key, value, timeout):
+                stored[key] = value
+        tags_cache, tags.cache = tags.cache, RecordingCache()
+        try:
+            self.assertEqual(t.render(Context()), "comment 2,comment 1,")
+            self.assertEqual(stored.values(),
+                             [[comments[2].pk, comments[1].pk]])
+            # comments by pk, and their articles
+            with self.assertNumQueries(2):
+                self.assertEqual(t.render(Context()), "comment 2,comment 1,")
+        finally:
+            tags.cache = tags_cache
+
+    def test_malformed_app_model_fails_on_parse(self):
+        self.assertRaises(TemplateSyntaxError, Template,
+                          "{% load comments_xtd %}"
+                          "{% render_last_xtdcomments 5 for article %}")
 
 
 @unittest.skipIf(not formatter, "This test case needs django-markup, docutils and markdown installed to be run")
@@ -18,6 +118,17 @@ An [example](http://url.com/ "Title")'''
         self.assertEqual(result,
                          '<p>An <a href="http://url.com/" title="Title">example</a></p>')
 
+    def test_render_markup_comment_uses_comment_html(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        comment = XtdComment.objects.create(
+            content_type=ContentType.objects.get_for_model(article),
+            object_pk=article.id, content_object=article, site_id=1,
+            comment="#!markdown\n*emphasis*", submit_date=datetime.now())
+        self.assertEqual(comment.comment_html, '<p><em>emphasis</em></p>')
+        comment.comment_html = '<p>stored</p>'
+        self.assertEqual(render_markup_comment(comment), '<p>stored</p>')
+
     def test_render_markup_comment_in_restructuredtext(self):
         comment = r'''#!restructuredtext
 A fibonacci generator in Python, taken from `LiteratePrograms <http://en.literateprograms.org/Fibonacci_numbers_%28Python%29>`_::
@@ -48,3 +159,71 @@ class MarkupNotAvailableTestCase(DjangoTestCase):
 An [example](http://url.com/ "Title")'''
         render_markup_comment, comment
         self.assertRaises(TemplateSyntaxError, render_markup_comment, comment)
+
+
+class RenderXtdCommentTreeTestCase(DjangoTestCase):
+
+    def test_render_nested_lists(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        article_ct = ContentType.objects.get_for_model(article)
+        def post(text, parent_id=0):
+            return XtdComment.objects.create(
+                content_type=article_ct, object_pk=article.id,
+                content_object=article, site_id=1, comment=text,
+                submit_date=datetime.now(), parent_id=parent_id)
+        c1 = post("first")
+        post("reply", parent_id=c1.id)
+        post("second")
+        t = Template("{% load comments_xtd %}"
+                     "{% render_xtdcomment_tree for article %}")
+        output = t.render(Context({"article": article}))
+        self.assertEqual(output.count("<ul"), 2)
+        self.assertEqual(output.count("<li>"), 3)
+        self.assert_(output.index("first") < output.index("reply") <
+                     output.index("second"))
+
+    def test_render_limited_tree(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        article_ct = ContentType.objects.get_for_model(article)
+        def post(text, parent_id=0):
+            return XtdComment.objects.create(
+                content_type=article_ct, object_pk=article.id,
+                content_object=article, site_id=1, comment=text,
+                submit_date=datetime.now(), parent_id=parent_id)
+        c1 = post("first")
+        post("reply", parent_id=c1.id)
+        post("another reply", parent_id=c1.id)
+        post("second")
+        t = Template("{% load comments_xtd %}"
+                     "{% render_xtdcomment_tree for article children 1 %}")
+        output = t.render(Context({"article": article}))
+        self.assertEqual(output.count("<li>"), 2)
+        self.assertEqual(output.count("xtdcomment-more"), 2)
+        self.assert_("second" not in output)
+        self.assert_("another reply" not in output)
+        self.assert_("?skip=1&amp;children=1" in output)
+        self.assert_("Load 1 more reply" in output)
+
+
+class RenderBatchTestCase(DjangoTestCase):
+
+    def test_batch_uses_the_comment_template_of_the_model(self):
+        article = Article.objects.create(
+            title="September", slug="september", body="During September...")
+        XtdComment.objects.create(
+            content_type=ContentType.objects.get_for_model(article),
+            object_pk=article.id, content_object=article, site_id=1,
+            comment="a comment", submit_date=datetime.now())
+        # as if there was a django_comments_xtd/tests/article/comment.html
+        key = ("tests", "article", None, "comment.html")
+        utils._comment_templates[key] = Template(
+            "<p>article: {{ comment.comment }}</p>")
+        try:
+            t = Template("{% load comments_xtd %}"
+                         "{% render_last_xtdcomments 5 for tests.article batch %}")
+            self.assertEqual(t.render(Context()).strip(),
+                             "<p>article: a comment</p>")
+        finally:
+            del utils._comment_templates[key]
@@ -1,4 +1,5 @@
 from datetime import datetime
+import json
 import re
 import threading
 
@@ -8,15 +9,21 @@ from django.contrib.comments.signals import comment_was_posted
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import cache
+from django.core.signals import request_finished
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.http import HttpResponse
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from django_comments_xtd import signals, signed
-from django_comments_xtd.models import XtdComment, TmpXtdComment
-from django_comments_xtd.tests.models import Article
+from django_comments_xtd import (executors, pending, signals, signed, stream,
+                                 utils, views)
+from django_comments_xtd.executors import DatabaseQueueExecutor
+from django_comments_xtd.models import (XtdComment, TmpXtdComment,
+                                        DigestEntry, NotificationJob,
+                                        PendingComment)
+from django_comments_xtd.tests.models import Article, Diary
 from django_comments_xtd.views import on_comment_was_posted, SALT
 from django_comments_xtd.utils import mail_sent_queue
 
@@ -91,6 +98,14 @@ class ConfirmCommentTestCase(TestCase):
         self.get_confirm_comment_url(self.key)
         self.assertContains(self.response, "404", status_code=404)
         
+    def test_create_comment_twice_returns_none(self):
+        # simulate two visits to the confirmation URL that pass the
+        # _comment_exists check at the same time
+        tmp_comment = signed.loads_comment(self.key, extra_key=SALT)
+        self.assert_(views._create_comment(tmp_comment) is not None)
+        self.assert_(views._create_comment(tmp_comment) is None)
+        self.assertEqual(XtdComment.objects.count(), 1)
+
     def test_signal_receiver_may_discard_the_comment(self):
         # test that receivers of signal confirmation_received may return False
         # and thus rendering a template_discarded output
@@ -109,7 +124,7 @@ class ConfirmCommentTestCase(TestCase):
         # and redirects to the article detail page
         Site.objects.get_current().domain = "testserver" # django bug #7743
         self.get_confirm_comment_url(self.key)
-        data = signed.loads(self.key, extra_key=SALT)
+        data = signed.loads_comment(self.key, extra_key=SALT)
         try:
             comment = XtdComment.objects.get(
                 content_type=data["content_type"], 
@@ -149,6 +164,378 @@ class ConfirmCommentTestCase(TestCase):
         self.assert_(mail.outbox[2].body.find("There is a new comment following up yours.") > -1)
 
 
+class PendingStoreConfirmCommentTestCase(TestCase):
+    def setUp(self):
+        pending._store = pending.DatabasePendingStore()
+        self.article = Article.objects.create(title="September", 
+                                              slug="september",
+                                              body="What I did on September...")
+        self.form = comments.get_form()(self.article)
+        data = {"name": "Bob", "email": "bob@example.com", "followup": True, 
+                "reply_to": 0, "level": 1, "order": 1,
+                "comment": "Es war einmal iene kleine..." }
+        data.update(self.form.initial)
+        self.client.post(reverse("comments-post-comment"), data=data)
+        if mail_sent_queue.get(block=True):
+            pass
+        self.key = re.search(r'http://.+/confirm/(?P<key>[\S]+)', 
+                             mail.outbox[0].body).group("key")
+
+    def tearDown(self):
+        pending._store = None
+
+    def get_confirm_comment_url(self, key):
+        return self.client.get(reverse("comments-xtd-confirm",
+                                       kwargs={'key': key}))
+
+    def test_url_only_carries_the_id(self):
+        self.assert_(self.key.startswith(signed.COMMENT_ID_TOKEN_PREFIX))
+        self.assert_(len(self.key) < 40)
+        self.assertEqual(PendingComment.objects.count(), 1)
+
+    def test_confirm_creates_comment_and_removes_pending_comment(self):
+        Site.objects.get_current().domain = "testserver" # django bug #7743
+        response = self.get_confirm_comment_url(self.key)
+        # to the comment URL, that redirects to the article in turn
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(XtdComment.objects.count(), 1)
+        self.assertTrue(response['Location'].endswith(
+            XtdComment.objects.get().get_absolute_url()))
+        self.assertEqual(PendingComment.objects.count(), 0)
+        response = self.get_confirm_comment_url(self.key)
+        self.assertEqual(response.status_code, 404)
+
+    def test_purge_removes_expired_comments(self):
+        self.assertEqual(pending._store.purge(), 0)
+        PendingComment.objects.update(
+            created=datetime(2012, 12, 12))
+        self.assertEqual(pending._store.purge(), 1)
+        self.assertEqual(PendingComment.objects.count(), 0)
+        response = self.get_confirm_comment_url(self.key)
+        self.assertEqual(response.status_code, 404)
+
+
+class FollowupDigestTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+        self.window = views.NOTIFY_DIGEST_WINDOW
+        # a long window, so that the digest is only sent by the test
+        views.NOTIFY_DIGEST_WINDOW = 3600
+
+    def tearDown(self):
+        views.NOTIFY_DIGEST_WINDOW = self.window
+
+    def post_comment(self, name, email):
+        comment = XtdComment.objects.create(content_object=self.article,
+                                            site_id=1, user_name=name,
+                                            user_email=email, followup=True,
+                                            comment="Comment by %s" % name,
+                                            submit_date=datetime.now())
+        views.notify_comment_followers(comment)
+        return comment
+
+    def test_comments_are_coalesced_in_one_email(self):
+        self.post_comment("Bob", "bob@example.com")
+        self.post_comment("Alice", "alice@example.com")
+        self.post_comment("Carol", "carol@example.com")
+        self.assertEqual(len(mail.outbox), 0) # all of them buffered
+        views.send_followup_digest(
+            ContentType.objects.get_for_model(Article).id, self.article.id)
+        for i in range(3):
+            mail_sent_queue.get(block=True)
+        self.assertEqual(len(mail.outbox), 3)
+        sent = dict((m.to[0], m.body) for m in mail.outbox)
+        self.assert_(sent["bob@example.com"].find("Comment by Bob") == -1)
+        self.assert_(sent["bob@example.com"].find("Comment by Alice") > -1)
+        self.assert_(sent["bob@example.com"].find("Comment by Carol") > -1)
+
+    def test_send_due_digests(self):
+        self.post_comment("Bob", "bob@example.com")
+        self.post_comment("Alice", "alice@example.com")
+        self.assertEqual(views.send_due_digests(), 0)
+        self.assertEqual(DigestEntry.objects.count(), 2)
+        # the window of the article closes
+        DigestEntry.objects.update(created=datetime(2012, 12, 12))
+        self.assertEqual(views.send_due_digests(), 1)
+        for i in range(2):
+            mail_sent_queue.get(block=True)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ["alice@example.com", "bob@example.com"])
+        self.assertEqual(DigestEntry.objects.count(), 0)
+        self.assertEqual(views.send_due_digests(), 0)
+
+    def test_followers_of_other_models_are_left_out(self):
+        # a diary with the same pk as the article
+        diary = Diary.objects.create(pk=self.article.pk, body="About Today...")
+        XtdComment.objects.create(content_object=diary, site_id=1,
+                                  user_name="Dave", user_email="dave@example.com",
+                                  followup=True, comment="Comment by Dave",
+                                  submit_date=datetime.now())
+        self.post_comment("Bob", "bob@example.com")
+        self.assertEqual(
+            views._get_followers(ContentType.objects.get_for_model(Article),
+                                 self.article.pk),
+            {"bob@example.com": "Bob"})
+
+
+class DatabaseQueueExecutorTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+        for name in ["Bob", "Alice"]:
+            comment = XtdComment.objects.create(
+                content_object=self.article, site_id=1, user_name=name,
+                user_email="%s@example.com" % name.lower(), followup=True,
+                comment="Comment by %s" % name, submit_date=datetime.now())
+        self.comment = comment
+
+    def test_submit_only_queues_the_job(self):
+        executor = DatabaseQueueExecutor()
+        executor.submit(self.comment.id)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(NotificationJob.objects.count(), 1)
+        self.assertEqual(executor.process(), 1)
+        mail_sent_queue.get(block=True)
+        self.assertEqual(NotificationJob.objects.count(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assert_(mail.outbox[0].to == ["bob@example.com"])
+
+    def test_claimed_jobs_are_not_claimed_again(self):
+        executor = DatabaseQueueExecutor()
+        executor.submit(self.comment.id)
+        executor.submit(self.comment.id - 1)
+        self.assertEqual(executor.claim(1), [self.comment.id])
+        self.assertEqual(executor.claim(5), [self.comment.id - 1])
+        self.assertEqual(executor.claim(5), [])
+        self.assertEqual(executor.process(), 0)
+
+
+class ThreadPoolExecutorTestCase(TestCase):
+    def setUp(self):
+        self.executor = executors.ThreadPoolExecutor()
+        self.queued = []
+        self.executor._put = self.queued.append
+
+    def test_job_is_queued_when_the_request_finishes(self):
+        # Tests run in a managed transaction, like requests under
+        # TransactionMiddleware.
+        utils.run_on_commit_callbacks()
+        self.executor.submit(1)
+        self.assertEqual(self.queued, [])
+        request_finished.send(sender=None)
+        self.assertEqual(self.queued, [1])
+
+    def test_job_of_missing_comment_is_run_once(self):
+        calls = []
+        def run_notification_job(comment_id):
+            calls.append(comment_id)
+            return False
+        orig = executors.run_notification_job
+        executors.run_notification_job = run_notification_job
+        try:
+            self.executor._run(1)
+        finally:
+            executors.run_notification_job = orig
+        self.assertEqual(calls, [1])
+
+
+class ListForObjectTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+        c1, c2, c3 = [
+            XtdComment.objects.create(content_object=self.article,
+                                      site_id=1, comment="comment %d" % i,
+                                      submit_date=datetime.now())
+            for i in range(1, 4)]
+        c4 = XtdComment.objects.create(content_object=self.article,
+                                       site_id=1, comment="reply to 1",
+                                       parent_id=c1.pk,
+                                       submit_date=datetime.now())
+        # in thread order
+        self.comments = [c1, c4, c2, c3]
+        self.url = reverse("comments-xtd-list-for-object",
+                           kwargs={'id': self.article.id,
+                                   'app_model': 'tests.article'})
+        self.comments_per_page = views.COMMENTS_PER_PAGE
+        views.COMMENTS_PER_PAGE = 2
+
+    def tearDown(self):
+        views.COMMENTS_PER_PAGE = self.comments_per_page
+
+    def get_page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return (list(response.context['comment_list']),
+                response.context['next_cursor'])
+
+    def test_pages_follow_the_cursor(self):
+        c1, c4, c2, c3 = self.comments
+        comments, cursor = self.get_page()
+        self.assertEqual(comments, [c1, c4])
+        self.assertEqual(cursor, "%d-%d" % (c4.thread_id, c4.order))
+        comments, cursor = self.get_page(after=cursor)
+        self.assertEqual(comments, [c2, c3])
+        self.assertEqual(cursor, None)
+
+    def test_pages_of_whole_threads(self):
+        c1, c4, c2, c3 = self.comments
+        comments, cursor = self.get_page(threads=1)
+        self.assertEqual(comments, [c1, c4, c2])
+        comments, cursor = self.get_page(threads=1, after=cursor)
+        self.assertEqual(comments, [c3])
+        self.assertEqual(cursor, None)
+
+    def test_bad_cursor(self):
+        response = self.client.get(self.url, {'after': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CommentsSinceTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+        self.comments = [
+            XtdComment.objects.create(content_object=self.article,
+                                      site_id=1, comment="comment %d" % i,
+                                      submit_date=datetime(2013, 9, i + 1))
+            for i in range(3)]
+        # The short dicts describe objects of the project, not articles.
+        for comment in self.comments:
+            cache.set("_comment_dict_%d_" % comment.pk, {"id": comment.pk})
+        self.url = reverse("comments-xtd-since-for-object",
+                           kwargs={'id': self.article.id,
+                                   'app_model': 'tests.article'})
+
+    def tearDown(self):
+        cache.clear()
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        return [c['id'] for c in data['comments']], data['last_id']
+
+    def test_after(self):
+        pks = [c.pk for c in self.comments]
+        self.assertEqual(self.get(after=pks[0]), (pks[1:], pks[2]))
+        self.assertEqual(self.get(after=pks[0], limit=1), (pks[1:2], pks[1]))
+        self.assertEqual(self.get(after=pks[2]), ([], pks[2]))
+
+    def test_since(self):
+        pks = [c.pk for c in self.comments]
+        self.assertEqual(self.get(since="2013-09-02T00:00:00"),
+                         (pks[2:], pks[2]))
+
+    def test_bad_parameters(self):
+        for params in [{'after': 'x'}, {'since': 'yesterday'},
+                       {'limit': 0}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+
+
+class RecordingBroker(object):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, comment_id):
+        self.published.append((channel, comment_id))
+
+    def wait(self, channel, after_id, timeout):
+        return None
+
+
+class CommentsStreamTestCase(TestCase):
+    def setUp(self):
+        self.article = Article.objects.create(title="September",
+                                              slug="september",
+                                              body="What I did on September...")
+        self.comments = [
+            XtdComment.objects.create(content_object=self.article,
+                                      site_id=1, comment=text,
+                                      submit_date=datetime.now())
+            for text in ("first", "second")]
+        # The short dicts describe objects of the project, not articles.
+        for comment in self.comments:
+            cache.set("_comment_dict_%d_" % comment.pk, {"id": comment.pk})
+        self.url = reverse("comments-xtd-stream",
+                           kwargs={'id': self.article.id,
+                                   'app_model': 'tests.article'})
+        self.broker = stream._broker
+        self.timeouts = (views.STREAM_TIMEOUT, views.STREAM_MAX_AGE)
+        views.STREAM_TIMEOUT, views.STREAM_MAX_AGE = 0.01, 0.05
+
+    def tearDown(self):
+        cache.clear()
+        stream._broker = self.broker
+        views.STREAM_TIMEOUT, views.STREAM_MAX_AGE = self.timeouts
+
+    def test_long_poll_returns_new_comments(self):
+        response = self.client.get(self.url, {'after': 0})
+        data = json.loads(response.content)
+        self.assertEqual([c['id'] for c in data['comments']],
+                         [c.pk for c in self.comments])
+        self.assertEqual(data['last_id'], self.comments[-1].pk)
+
+    def test_long_poll_times_out_empty(self):
+        response = self.client.get(self.url, {'after': self.comments[-1].pk})
+        data = json.loads(response.content)
+        self.assertEqual(data['comments'], [])
+        self.assertEqual(data['last_id'], self.comments[-1].pk)
+
+    def test_event_stream_ends_after_max_age(self):
+        response = self.client.get(self.url, {'after': self.comments[0].pk},
+                                   HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = ''.join(response.streaming_content)
+        self.assertTrue(("id: %d\n" % self.comments[-1].pk) in content)
+        self.assertEqual(content.count("data: "), 1)
+
+    def test_comment_is_published_when_the_request_finishes(self):
+        # Tests run in a managed transaction, like requests under
+        # TransactionMiddleware.
+        utils.run_on_commit_callbacks()
+        broker = stream._broker = RecordingBroker()
+        reply = XtdComment.objects.create(content_object=self.article,
+                                          site_id=1, comment="reply",
+                                          parent_id=self.comments[0].pk,
+                                          submit_date=datetime.now())
+        self.assertEqual(broker.published, [])
+        request_finished.send(sender=None)
+        self.assertEqual(broker.published,
+                         [(stream.get_channel(reply.content_type_id,
+                                              reply.object_pk), reply.pk)])
+
+    def test_rolled_back_comment_is_not_published(self):
+        utils.run_on_commit_callbacks()
+        broker = stream._broker = RecordingBroker()
+        reply = XtdComment.objects.create(content_object=self.article,
+                                          site_id=1, comment="reply",
+                                          parent_id=self.comments[0].pk,
+                                          submit_date=datetime.now())
+        XtdComment.objects.filter(pk=reply.pk).delete() # as a rollback
+        request_finished.send(sender=None)
+        self.assertEqual(broker.published, [])
+
+    def test_pending_comments_are_bounded_outside_requests(self):
+        utils.run_on_commit_callbacks()
+        broker = stream._broker = RecordingBroker()
+        max_pending, utils.ON_COMMIT_MAX_PENDING = (
+            utils.ON_COMMIT_MAX_PENDING, 1)
+        try:
+            for comment in self.comments:
+                stream.publish_comment_on_commit(comment)
+        finally:
+            utils.ON_COMMIT_MAX_PENDING = max_pending
+        self.assertEqual([pk for channel, pk in broker.published],
+                         [c.pk for c in self.comments])
+
+
 class ReplyNoCommentTestCase(TestCase):
     def test_reply_non_existing_comment_raises_404(self):
         response = self.client.get(reverse("comments-xtd-reply", 
@@ -196,6 +583,63 @@ class ReplyCommentTestCase(TestCase):
         self.assertTemplateUsed(response, 
                                 "django_comments_xtd/max_thread_level.html")
 
+    def test_replies_renders_subtree(self):
+        response = self.client.get(reverse("comments-xtd-replies",
+                                           kwargs={"cid": 1}))
+        self.assertContains(response, 'id="c2"')
+        self.assertContains(response, 'id="c3"')
+        self.assertNotContains(response, 'id="c1"')
+
+    def test_replies_collapses_deeper_levels(self):
+        max_depth = views.TREE_MAX_DEPTH
+        views.TREE_MAX_DEPTH = 1
+        try:
+            response = self.client.get(reverse("comments-xtd-replies",
+                                               kwargs={"cid": 1}))
+        finally:
+            views.TREE_MAX_DEPTH = max_depth
+        self.assertContains(response, 'id="c2"')
+        self.assertNotContains(response, 'id="c3"')
+        self.assertContains(response, reverse("comments-xtd-replies",
+                                              kwargs={"cid": 2}))
+
+    def test_replies_links_keep_the_limits(self):
+        response = self.client.get(reverse("comments-xtd-replies",
+                                           kwargs={"cid": 1}),
+                                   {"depth": 1, "children": 1})
+        self.assertContains(response, 'id="c2"')
+        self.assertNotContains(response, 'id="c3"')
+        self.assertContains(response, reverse(
+            "comments-xtd-replies", kwargs={"cid": 2}) +
+            "?depth=1&amp;children=1")
+
+    def test_replies_bad_parameters(self):
+        url = reverse("comments-xtd-replies", kwargs={"cid": 1})
+        for params in [{"skip": "x"}, {"skip": -1}, {"children": 0}]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_tree_for_object_loads_more_top_level_comments(self):
+        article = Article.objects.get()
+        XtdComment.objects.create(content_object=article, site_id=1,
+                                  comment="comment 4 to article",
+                                  submit_date=datetime.now())
+        url = reverse("comments-xtd-tree-for-object",
+                      kwargs={"id": article.id, "app_model": "tests.article"})
+        response = self.client.get(url, {"children": 1})
+        self.assertContains(response, 'id="c1"')
+        self.assertNotContains(response, 'id="c4"')
+        self.assertContains(response, url + "?skip=1&amp;children=1")
+        response = self.client.get(url, {"children": 1, "skip": 1})
+        self.assertContains(response, 'id="c4"')
+        self.assertNotContains(response, 'id="c1"')
+        self.assertNotContains(response, 'xtdcomment-more')
+
+    def test_replies_to_non_existing_comment_raises_404(self):
+        response = self.client.get(reverse("comments-xtd-replies",
+                                           kwargs={"cid": 99}))
+        self.assertEqual(response.status_code, 404)
+
 
 class CommentsForObjectViewTestCase(TestCase):
     def setUp(self):
@@ -209,6 +653,9 @@ class CommentsForObjectViewTestCase(TestCase):
 
         XtdComment.objects.create(content_object=article1, site_id=1,
                                   comment="Bye", submit_date="2012-12-12")
+        # permalinks carry the content type id
+        self.cr = reverse("comments-url-redirect", args=(
+            ContentType.objects.get_for_model(Article).pk, self.article.pk))
         
     def test_get(self):
         response = self.client.get(reverse(
@@ -221,17 +668,47 @@ class CommentsForObjectViewTestCase(TestCase):
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi 1</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c2">permalink</a><br/><span>12/12/2012</span><br/>
+        <a href="%(cr)s#c2">permalink</a><br/><span>12/12/2012</span><br/>
         <em></em></div></div>
         <div id="c1" style="width:600px; padding: 5px 0; border-top: 1px solid #ddd">
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c1">permalink</a><br/><span>12/12/2012</span><br/>
-        <em></em></div></div>'''
+        <a href="%(cr)s#c1">permalink</a><br/><span>12/12/2012</span><br/>
+        <em></em></div></div>''' % {'cr': self.cr}
 
         self.assertHTMLEqual(expected_html, response.content)
 
+    def test_get__batch(self):
+        url = reverse("comments-xtd-last-for-object",
+                      kwargs={'count': 5, 'id': self.article.id,
+                              'app_model': 'tests.article'})
+        response = self.client.get(url)
+        batch_response = self.client.get(url, {'batch': 1})
+        self.assertHTMLEqual(response.content, batch_response.content)
+
+    def test_get__unknown_model(self):
+        url = reverse("comments-xtd-last-for-object",
+                      kwargs={'count': 5, 'id': self.article.id,
+                              'app_model': 'tests.unknown'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional_get(self):
+        url = reverse("comments-xtd-last-for-object",
+                      kwargs={'count': 5, 'id': self.article.id,
+                              'app_model': 'tests.article'})
+        response = self.client.get(url)
+        etag = response["ETag"]
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # a new comment changes the version of the comments of the article
+        XtdComment.objects.create(content_object=self.article, site_id=1,
+                                  comment="Hi 2", submit_date="2012-12-12")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
     def test_get__reverse(self):
         response = self.client.get(reverse(
             "comments-xtd-last-for-object",
@@ -243,15 +720,15 @@ class CommentsForObjectViewTestCase(TestCase):
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c1">permalink</a><br/><span>12/12/2012</span><br/>
+        <a href="%(cr)s#c1">permalink</a><br/><span>12/12/2012</span><br/>
         <em></em></div></div>
         <div id="c2" style="width:600px; padding: 5px 0; border-top: 1px solid #ddd">
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi 1</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c2">permalink</a><br/><span>12/12/2012</span><br/>
+        <a href="%(cr)s#c2">permalink</a><br/><span>12/12/2012</span><br/>
         <em></em></div></div>
-        '''
+        ''' % {'cr': self.cr}
 
         self.assertHTMLEqual(expected_html, response.content)
 
@@ -270,14 +747,14 @@ class CommentsForObjectViewTestCase(TestCase):
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi 1</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c2">permalink</a><br/><span>12/12/2012</span><br/>
+        <a href="%(cr)s#c2">permalink</a><br/><span>12/12/2012</span><br/>
         <em></em></div></div>
         <div id="c4" style="width:600px; padding: 5px 0; border-top: 1px solid #ddd">
         <div style="display:inline-block; width:400px"><div style="font-size:0.7em">
         Comment for: <a href=""></a></div><p>Hi 2</p></div>
         <div style="display:inline-block; width:180px; padding: 0 5px; background:#eee">
-        <a href="/comments/cr/10/1/#c4">permalink</a><br/><span>12/12/2012</span><br/>
+        <a href="%(cr)s#c4">permalink</a><br/><span>12/12/2012</span><br/>
         <em></em></div></div>
-        '''
+        ''' % {'cr': self.cr}
 
         self.assertHTMLEqual(expected_html, response.content)
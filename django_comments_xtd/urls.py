@@ -14,6 +14,16 @@ urlpatterns = patterns('',
     url(r'^confirm/(?P<key>[^/]+)$', views.confirm, name='comments-xtd-confirm'),
     url(r'^last/(?P<count>[\d]+)/(?P<id>[\d]+)/(?P<app_model>[\w]+\.[\w]+)/$',
         views.last_for_object, name='comments-xtd-last-for-object'),
+    url(r'^replies/(?P<cid>[\d]+)/$', views.replies,
+        name='comments-xtd-replies'),
+    url(r'^tree/(?P<id>[\d]+)/(?P<app_model>[\w]+\.[\w]+)/$',
+        views.tree_for_object, name='comments-xtd-tree-for-object'),
+    url(r'^list/(?P<id>[\d]+)/(?P<app_model>[\w]+\.[\w]+)/$',
+        views.list_for_object, name='comments-xtd-list-for-object'),
+    url(r'^since/(?P<id>[\d]+)/(?P<app_model>[\w]+\.[\w]+)/$',
+        views.comments_since, name='comments-xtd-since-for-object'),
+    url(r'^stream/(?P<id>[\d]+)/(?P<app_model>[\w]+\.[\w]+)/$',
+        views.comments_stream, name='comments-xtd-stream'),
 )
 
 if allow_comment_threads:
@@ -2,10 +2,26 @@
 # http://ui.co.id/blog/asynchronous-send_mail-in-django
 
 import Queue
+import re
 import threading
+import time
+from collections import OrderedDict
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import EmailMultiAlternatives
+from django.core.signals import request_finished
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.template import loader
+from django.utils.html import escape, linebreaks
+from django.utils.http import urlencode
+from django.utils.importlib import import_module
+from django.utils.safestring import mark_safe
 
 
 mail_sent_queue = Queue.Queue()
@@ -41,3 +57,399 @@ def import_formatter():
         return formatter
     except ImportError:
         return False
+
+
+formatter = import_formatter()
+
+MARKUP_CACHE_SIZE = getattr(settings, 'COMMENTS_XTD_MARKUP_CACHE_SIZE', 1000)
+
+_markup_re = re.compile(r"^#!(?P<markup_filter>\w+)$")
+
+
+class MarkupNotAvailable(Exception):
+    pass
+
+
+def render_markup(value):
+    """
+    HTML of value rendered with the markup language named in its first
+    line, ie: "#!markdown". Returns None if value names no markup language.
+    Raises MarkupNotAvailable if the formatter is not installed.
+    """
+    lines = value.splitlines()
+    match_obj = lines and _markup_re.search(lines[0])
+    if not match_obj:
+        return None
+    if not formatter:
+        raise MarkupNotAvailable(
+            "In order to use this templatetag you need django-markup, docutils and markdown installed")
+    try:
+        return formatter("\n".join(lines[1:]),
+                         filter_name=match_obj.group('markup_filter'))
+    except ValueError, e:
+        return "<p>Warning: %s</p>%s" % (escape(e), linebreaks(value,
+                                                              autoescape=True))
+
+
+def render_comment_html(value):
+    """HTML stored for a comment: its rendered markup, or an empty string."""
+    try:
+        return render_markup(value) or ''
+    except MarkupNotAvailable:
+        return ''
+
+
+class LRUCache(object):
+    """Thread-safe mapping keeping the maxsize most recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def load_class(path, setting_name):
+    """Return the class given by its dotted path in the setting_name."""
+    module_name, class_name = path.rsplit('.', 1)
+    try:
+        return getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured("Error loading %s %s: %s" % (
+            setting_name, path, e))
+
+
+# Callbacks waiting for the managed transaction of the thread to end, and
+# how many may pile up when no request finishes to run them, ie: in
+# management commands and worker threads.
+_on_commit = threading.local()
+ON_COMMIT_MAX_PENDING = 100
+
+def on_commit(func, *args):
+    """
+    Call func(*args) once the transaction of the thread ends: right away
+    if it is not managed, and when the request finishes if it is, ie:
+    under TransactionMiddleware. Outside of requests, pending callbacks run
+    on the first call made out of transaction management, or once more than
+    ON_COMMIT_MAX_PENDING pile up.
+
+    Django 1.5 tells nothing about how a transaction ended, so func has to
+    check that what the transaction saved is there, ie: that it was not
+    rolled back.
+    """
+    if not transaction.is_managed():
+        run_on_commit_callbacks()
+        func(*args)
+        return
+    if not hasattr(_on_commit, 'callbacks'):
+        _on_commit.callbacks = []
+    _on_commit.callbacks.append((func, args))
+    if len(_on_commit.callbacks) > ON_COMMIT_MAX_PENDING:
+        run_on_commit_callbacks()
+
+def run_on_commit_callbacks(**kwargs):
+    callbacks = getattr(_on_commit, 'callbacks', None)
+    if callbacks:
+        _on_commit.callbacks = []
+        for func, args in callbacks:
+            func(*args)
+
+request_finished.connect(run_on_commit_callbacks)
+
+
+# Comments of an object have a version, the time they last changed. It is
+# kept in the cache and changes whenever a comment of the object is saved or
+# deleted, so that anything cached for the object can be keyed with it.
+# Content types have a version too, that changes with any of their objects'.
+COMMENTS_VERSION_TIMEOUT = 30 * 24 * 3600
+
+def _comments_version_key(content_type_id, object_pk=None):
+    if object_pk is None:
+        return "_xtd_comments_version_%d_" % content_type_id
+    return "_xtd_comments_version_%d_%s_" % (content_type_id, object_pk)
+
+def get_comments_version(content_type_id, object_pk=None):
+    """
+    Version of the comments of the given object, or of all the objects of 
+    the content type if object_pk is None, without a query.
+    """
+    key = _comments_version_key(content_type_id, object_pk)
+    version = cache.get(key)
+    if version is None:
+        # Unknown, or evicted from the cache: start a new version, so that
+        # nothing cached before is taken as current.
+        cache.add(key, time.time(), COMMENTS_VERSION_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+def bump_comments_version(content_type_id, object_pk):
+    """Invalidate anything cached for the comments of the given object."""
+    version = time.time()
+    cache.set_many({
+        _comments_version_key(content_type_id, object_pk): version,
+        _comments_version_key(content_type_id): version,
+    }, COMMENTS_VERSION_TIMEOUT)
+
+
+# ContentTypes by "app.model" label. The first lookup loads all of them
+# with one query, and any label added later is resolved along with the
+# other unknown labels of the same lookup.
+_content_types = {}
+_content_types_lock = threading.Lock()
+
+# Labels found unknown, so that looking them up again does not query.
+# Labels come from the URLs of the views, so they are kept in an LRUCache.
+_unknown_content_types = LRUCache(1000)
+
+def _load_content_types(app_models=None):
+    qs = ContentType.objects.all()
+    if app_models is not None:
+        query = Q()
+        for app_model in app_models:
+            app, model = app_model.split('.')
+            query |= Q(app_label=app, model=model)
+        qs = qs.filter(query)
+    with _content_types_lock:
+        for ct in qs:
+            _content_types["%s.%s" % (ct.app_label, ct.model)] = ct
+            # also serves ContentType.objects.get_for_id, unless the row is
+            # stale, left behind by a removed app, and has no model
+            if ct.model_class() is not None:
+                ContentType.objects._add_to_cache(ContentType.objects.db, ct)
+
+def get_content_types(app_models):
+    """
+    ContentTypes for the given "app.model" labels, in the same order. 
+    Raises ValueError for malformed labels and ContentType.DoesNotExist for
+    unknown ones. Issues one query at most, and none once the labels have
+    been looked up, known or not.
+    """
+    for app_model in app_models:
+        if len(app_model.split('.')) != 2:
+            raise ValueError("%r is not in the format 'app.model'" % app_model)
+    if not _content_types:
+        _load_content_types()
+    missing = [label for label in app_models
+               if label not in _content_types and
+               not _unknown_content_types.get(label)]
+    if missing:
+        _load_content_types(missing)
+        for label in missing:
+            if label not in _content_types:
+                _unknown_content_types.set(label, True)
+    try:
+        return [_content_types[app_model] for app_model in app_models]
+    except KeyError, e:
+        raise ContentType.DoesNotExist(
+            "ContentType matching %s does not exist." % e)
+
+def get_content_type(app_model):
+    """ContentType for the given "app.model" label. See get_content_types."""
+    return get_content_types([app_model])[0]
+
+def clear_content_types_cache(**kwargs):
+    with _content_types_lock:
+        _content_types.clear()
+    _unknown_content_types.clear()
+
+# new content types may be among the unknown labels
+post_save.connect(clear_content_types_cache, sender=ContentType)
+post_delete.connect(clear_content_types_cache, sender=ContentType)
+
+
+# Compiled comment templates, by (app_label, model, template_path, name).
+_comment_templates = {}
+
+def get_comment_template(content_type, template_path=None,
+                         name="comment.html"):
+    """
+    Compiled template used to render comments to objects of the given
+    content type. The fallback list is only resolved the first time, unless
+    settings.DEBUG is True, so that changes in templates show up.
+    """
+    key = (content_type.app_label, content_type.model, template_path, name)
+    template = _comment_templates.get(key)
+    if template is None:
+        if template_path:
+            template = loader.get_template(template_path)
+        else:
+            template = loader.select_template([
+                "django_comments_xtd/%s/%s/%s" % (content_type.app_label,
+                                                  content_type.model, name),
+                "django_comments_xtd/%s/%s" % (content_type.app_label, name),
+                "django_comments_xtd/%s" % name
+            ])
+        if not settings.DEBUG:
+            _comment_templates[key] = template
+    return template
+
+def render_comments(comments, context, template_path=None, batch=False):
+    """
+    Render the given comments in the context, reusing the compiled template
+    of each content type.
+
+    With batch=True, each run of comments to the same content type is
+    rendered in one pass through the ``comment_batch.html`` template, that 
+    receives them in ``comment_list``. Then template_path, if given, is the 
+    batch template.
+    """
+    templates = {}
+    def get_template(content_type_id, name):
+        if content_type_id not in templates:
+            templates[content_type_id] = get_comment_template(
+                ContentType.objects.get_for_id(content_type_id),
+                template_path, name=name)
+        return templates[content_type_id]
+
+    strlist = []
+    if batch:
+        runs = []
+        for comment in comments:
+            if runs and runs[-1][0] == comment.content_type_id:
+                runs[-1][1].append(comment)
+            else:
+                runs.append((comment.content_type_id, [comment]))
+        for content_type_id, comment_list in runs:
+            template = get_template(content_type_id, "comment_batch.html")
+            context.push()
+            context["comment_list"] = comment_list
+            strlist.append(template.render(context))
+            context.pop()
+    else:
+        for comment in comments:
+            template = get_template(comment.content_type_id, "comment.html")
+            context.push()
+            context["comment"] = comment
+            strlist.append(template.render(context))
+            context.pop()
+    return ''.join(strlist)
+
+# Default levels and replies per comment rendered by render_xtdcomment_tree
+# and the comments-xtd-replies view, None for all of them.
+TREE_MAX_DEPTH = getattr(settings, 'COMMENTS_XTD_TREE_MAX_DEPTH', None)
+TREE_MAX_CHILDREN = getattr(settings, 'COMMENTS_XTD_TREE_MAX_CHILDREN', None)
+
+def _more_replies_stub(template, context, url, count, skip, max_depth,
+                       max_children):
+    params = [(name, value) for name, value in [
+        ("skip", skip), ("depth", max_depth), ("children", max_children)
+    ] if value]
+    if params:
+        url += "?" + urlencode(params)
+    context.push()
+    context["url"] = url
+    context["count"] = count
+    stub = template.render(context)
+    context.pop()
+    return stub
+
+def _more_url(tree, parent):
+    """URL of the view returning the top level comments of tree."""
+    if parent is not None:
+        return reverse("comments-xtd-replies", kwargs={"cid": parent.pk})
+    comment = tree[0]['comment']
+    content_type = ContentType.objects.get_for_id(comment.content_type_id)
+    return reverse("comments-xtd-tree-for-object", kwargs={
+        "id": comment.object_pk,
+        "app_model": "%s.%s" % (content_type.app_label, content_type.model)})
+
+def render_comment_tree(tree, context, template_path=None, parent=None,
+                        skip=0, max_depth=None, max_children=None):
+    """
+    Render a tree of comments, as returned by tree_for_object, as nested
+    lists with every comment rendered by its comment template. Each list
+    goes through the ``comment_tree.html`` template, that receives the
+    rendered comments, each with its rendered replies, in ``items``. Walks
+    the tree with a stack instead of recursion, so that deep threads cost
+    the same as flat ones.
+
+    Replies left out of the tree, counted in the 'more' of their parent's
+    node, are replaced with a link to load them from the view
+    ``comments-xtd-replies``, and top level comments left out with a link
+    to ``comments-xtd-tree-for-object``, both rendered through the
+    ``comment_tree_more.html`` template. parent is the comment the tree
+    holds the replies to, if any, and skip the number of its replies left
+    out before the tree. max_depth and max_children, the limits the tree
+    was loaded with, are passed on in the links.
+    """
+    templates = {}
+    def get_template(content_type_id, name):
+        key = (content_type_id, name)
+        if key not in templates:
+            templates[key] = get_comment_template(
+                ContentType.objects.get_for_id(content_type_id),
+                name == "comment.html" and template_path or None, name=name)
+        return templates[key]
+
+    # the lists of a tree are rendered with the templates of its object
+    first = tree and tree[0]['comment'] or parent
+    if first is not None:
+        list_template = get_template(first.content_type_id, "comment_tree.html")
+        more_template = get_template(first.content_type_id,
+                                     "comment_tree_more.html")
+    else:
+        list_template = loader.get_template(
+            "django_comments_xtd/comment_tree.html")
+        more_template = loader.get_template(
+            "django_comments_xtd/comment_tree_more.html")
+
+    # (children left, parent comment, replies hidden, replies shown,
+    #  items rendered, item of the parent)
+    stack = [(iter(tree), None, getattr(tree, 'more', 0), skip + len(tree),
+              [], None)]
+    while True:
+        try:
+            node = next(stack[-1][0])
+        except StopIteration:
+            children, comment, hidden, shown, items, item = stack.pop()
+            more = ''
+            if hidden:
+                if stack:
+                    url = reverse("comments-xtd-replies",
+                                  kwargs={"cid": comment.pk})
+                else:
+                    url = _more_url(tree, parent)
+                more = _more_replies_stub(more_template, context, url, hidden,
+                                          shown, max_depth, max_children)
+            context.push()
+            context["items"] = items
+            context["more"] = mark_safe(more)
+            context["is_root"] = not stack
+            html = list_template.render(context)
+            context.pop()
+            if not stack:
+                return html
+            item["replies"] = mark_safe(html)
+            stack[-1][4].append(item)
+            continue
+        comment = node['comment']
+        context.push()
+        context["comment"] = comment
+        item = {"comment": comment, "replies": "", "html": mark_safe(
+            get_template(comment.content_type_id, "comment.html").render(
+                context))}
+        context.pop()
+        if node['children'] or node.get('more'):
+            stack.append((iter(node['children']), comment,
+                          node.get('more', 0), len(node['children']), [], item))
+        else:
+            stack[-1][4].append(item)
@@ -1,24 +1,46 @@
-from django.db import models
+from django.db import connection, models, transaction, IntegrityError
+import json
+import time
+from datetime import datetime, timedelta
+from hashlib import md5
+
 from django.conf import settings
 from django.contrib.comments import get_form
 from django.contrib.comments.signals import comment_was_posted
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseRedirect, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect, render_to_response
 from django.template import loader, Context, RequestContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.http import condition
 
 from django_comments_xtd import signals, signed
+from django_comments_xtd.executors import get_notification_executor
+from django_comments_xtd.pending import get_pending_store
+from django_comments_xtd.stream import (get_broker, get_channel,
+                                        STREAM_MAX_AGE, STREAM_TIMEOUT)
 from django_comments_xtd.models import (XtdComment, TmpXtdComment, 
+                                        DigestEntry, comment_fingerprint,
                                         max_thread_level_for_content_type)
-from django_comments_xtd.utils import send_mail
+from django_comments_xtd.utils import (send_mail, get_comments_version,
+                                       get_comment_template, get_content_type,
+                                       render_comments, render_comment_tree,
+                                       TREE_MAX_CHILDREN, TREE_MAX_DEPTH)
 
 
 SALT = getattr(settings, 'COMMENTS_XTD_SALT', "")
 CONFIRM_EMAIL = getattr(settings, 'COMMENTS_XTD_CONFIRM_EMAIL', True)
 MAX_THREAD_LEVEL = getattr(settings, 'COMMENTS_XTD_MAX_THREAD_LEVEL', 0)
+MAX_COMMENTS_SINCE = getattr(settings, 'COMMENTS_XTD_MAX_COMMENTS_SINCE', 100)
+COMMENTS_PER_PAGE = getattr(settings, 'COMMENTS_XTD_COMMENTS_PER_PAGE', 20)
+NOTIFY_DIGEST_WINDOW = getattr(settings, 'COMMENTS_XTD_NOTIFY_DIGEST_WINDOW', 0)
+LAST_FOR_OBJECT_CACHE_TIMEOUT = getattr(settings, 'COMMENTS_XTD_LAST_FOR_OBJECT_CACHE_TIMEOUT', 0)
 
 def send_email_confirmation_request(comment, target, key, text_template="django_comments_xtd/email_confirmation_request.txt", html_template="django_comments_xtd/email_confirmation_request.html"):
     """Send email requesting comment confirmation"""
@@ -41,21 +63,32 @@ def send_email_confirmation_request(comment, target, key, text_template="django_
 
 def _comment_exists(comment):
     """
-    True if exists a XtdComment with same user_name, user_email and submit_date.
+    True if exists a XtdComment with the same fingerprint: same author,
+    object, parent, body and submit_date.
     """
-    return (XtdComment.objects.filter(
-            user_name=comment.user_name, 
-            user_email=comment.user_email,
-            submit_date=comment.submit_date).count() > 0)
+    return XtdComment.objects.filter(
+        fingerprint=comment_fingerprint(comment)).exists()
 
 
 def _create_comment(tmp_comment):
     """
-    Creates a XtdComment from a TmpXtdComment.
+    Creates a XtdComment from a TmpXtdComment. Returns None if the comment
+    already exists, ie: when the same confirmation URL is visited twice at
+    the same time.
     """
     comment = XtdComment(**tmp_comment)
     comment.is_public = True
-    comment.save()
+    # A savepoint and not a transaction of its own: commit_on_success would
+    # commit the transaction of the caller, and save() manages its own.
+    # Rolling back to it lets PostgreSQL go on after the IntegrityError.
+    sid = transaction.savepoint()
+    try:
+        comment.save()
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        if _comment_exists(tmp_comment):
+            return None
+        raise
     return comment
 
 
@@ -69,16 +102,20 @@ def on_comment_was_posted(sender, comment, request, **kwargs):
     email to the person who posted the comment.
     """
     if not CONFIRM_EMAIL or (comment.user and comment.user.is_authenticated()):
-        if not _comment_exists(comment):
-            new_comment = _create_comment(comment)
+        new_comment = _create_comment(comment)
+        if new_comment is not None:
             comment.xtd_comment = new_comment
-            notify_comment_followers(new_comment)
+            get_notification_executor().submit(new_comment.id)
     else:
         ctype = request.POST["content_type"]
         object_pk = request.POST["object_pk"]
         model = models.get_model(*ctype.split("."))
         target = model._default_manager.get(pk=object_pk)
-        key = signed.dumps(comment, compress=True, extra_key=SALT)
+        store = get_pending_store()
+        if store is not None:
+            key = signed.dumps_comment_id(store.add(comment), extra_key=SALT)
+        else:
+            key = signed.dumps_comment(comment, compress=True, extra_key=SALT)
         send_email_confirmation_request(comment, target, key)
 
 if settings.COMMENTS_APP == "django_comments_xtd":
@@ -111,9 +148,24 @@ def sent(request):
             return redirect(comment)
 
 
+def _load_tmp_comment(key):
+    """
+    Return the TmpXtdComment of a confirmation key, and its id in the
+    pending comments store, if the key refers to one.
+    """
+    store = get_pending_store()
+    if store is not None and key.startswith(signed.COMMENT_ID_TOKEN_PREFIX):
+        pending_id = signed.loads_comment_id(key, extra_key=SALT)
+        tmp_comment = store.get(pending_id)
+        if tmp_comment is None:
+            raise ValueError("Pending comment %d not found" % pending_id)
+        return tmp_comment, pending_id
+    return signed.loads_comment(key, extra_key=SALT), None
+
+
 def confirm(request, key, template_discarded="django_comments_xtd/discarded.html"):
     try:
-        tmp_comment = signed.loads(key, extra_key=SALT)
+        tmp_comment, pending_id = _load_tmp_comment(key)
     except (ValueError, signed.BadSignature):
         raise Http404
 
@@ -127,6 +179,9 @@ def confirm(request, key, template_discarded="django_comments_xtd/discarded.html
                                                    request = request
     )
 
+    if pending_id is not None:
+        get_pending_store().delete(pending_id)
+
     # Check whether a signal receiver decides to discard the contact_msg
     for (receiver, response) in responses:
         if response == False:
@@ -135,23 +190,40 @@ def confirm(request, key, template_discarded="django_comments_xtd/discarded.html
                                       context_instance=RequestContext(request))
 
     comment = _create_comment(tmp_comment)
-    notify_comment_followers(comment)
+    if comment is None:
+        raise Http404
+    get_notification_executor().submit(comment.id)
     return redirect(comment)
 
 
-def notify_comment_followers(comment):
+def _get_followers(content_type, object_pk, exclude_ids=None):
+    """
+    Map email -> name of the people following the conversation on the given
+    object, leaving out the comments in exclude_ids.
+    """
     followers = {}
-
     previous_comments = XtdComment.objects.filter(
-        object_pk=comment.object_pk, is_public=True, 
-        followup=True).exclude(id__exact=comment.id)
-
+        content_type=content_type, object_pk=object_pk, is_public=True,
+        followup=True)
+    if exclude_ids:
+        previous_comments = previous_comments.exclude(id__in=exclude_ids)
     for instance in previous_comments:
         followers[instance.user_email] = instance.user_name
+    return followers
+
+
+def _get_target(content_type, object_pk):
+    model = models.get_model(content_type.app_label, content_type.model)
+    return model._default_manager.get(pk=object_pk)
+
 
-    model = models.get_model(comment.content_type.app_label,
-                             comment.content_type.model)
-    target = model._default_manager.get(pk=comment.object_pk)
+def notify_comment_followers(comment):
+    if NOTIFY_DIGEST_WINDOW:
+        return _buffer_followup_notification(comment)
+
+    followers = _get_followers(comment.content_type, comment.object_pk,
+                               exclude_ids=[comment.id])
+    target = _get_target(comment.content_type, comment.object_pk)
     subject = _("new comment posted")
     text_message_template = loader.get_template("django_comments_xtd/email_followup_comment.txt")
     html_message_template = loader.get_template("django_comments_xtd/email_followup_comment.html")
@@ -166,6 +238,77 @@ def notify_comment_followers(comment):
         send_mail(subject, text_message, settings.DEFAULT_FROM_EMAIL, [ email, ], html=html_message)
 
 
+def _buffer_followup_notification(comment):
+    """
+    Add the comment to the digest of its object, and send the digests whose
+    window has closed meanwhile.
+    """
+    DigestEntry.objects.create(content_type_id=comment.content_type_id,
+                               object_pk=comment.object_pk,
+                               comment_id=comment.id)
+    send_due_digests()
+
+
+def send_due_digests():
+    """
+    Send the digests of the objects whose first buffered comment is older
+    than NOTIFY_DIGEST_WINDOW. Run by every notification job and by the
+    command xtd_process_notifications, so that windows close even when no
+    more comments arrive. Returns the number of digests sent.
+    """
+    deadline = timezone.now() - timedelta(seconds=NOTIFY_DIGEST_WINDOW)
+    due = list(DigestEntry.objects.filter(created__lte=deadline).values_list(
+        'content_type_id', 'object_pk').distinct().order_by())
+    for content_type_id, object_pk in due:
+        send_followup_digest(content_type_id, object_pk)
+    return len(due)
+
+
+def send_followup_digest(content_type_id, object_pk):
+    """
+    Close the digest window of the given object and send one email to every
+    follower listing all the comments posted during the window.
+    """
+    # Claim the entries under lock: a concurrent sender waits and then finds
+    # them gone, and comments buffered meanwhile wait for the next window.
+    with transaction.commit_on_success():
+        entries = list(DigestEntry.objects.select_for_update().filter(
+            content_type_id=content_type_id, object_pk=object_pk
+        ).values_list('pk', 'comment_id'))
+        DigestEntry.objects.filter(
+            pk__in=[pk for pk, comment_id in entries]).delete()
+    comment_ids = [comment_id for pk, comment_id in entries]
+    if not comment_ids:
+        return
+
+    comments = list(XtdComment.objects.filter(id__in=comment_ids,
+                                              is_public=True))
+    if not comments:
+        return
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    # Authors of the buffered comments are followers too, they get to know
+    # about the rest of the comments of the window.
+    followers = _get_followers(content_type, object_pk)
+    target = _get_target(content_type, object_pk)
+    site = Site.objects.get_current()
+    subject = _("new comments posted")
+    text_message_template = loader.get_template("django_comments_xtd/email_followup_digest.txt")
+    html_message_template = loader.get_template("django_comments_xtd/email_followup_digest.html")
+
+    for email, name in followers.iteritems():
+        # Do not tell followers about their own comments.
+        new_comments = [c for c in comments if c.user_email != email]
+        if not new_comments:
+            continue
+        message_context = Context({ 'user_name': name,
+                                    'comments': new_comments,
+                                    'content_object': target,
+                                    'site': site })
+        text_message = text_message_template.render(message_context)
+        html_message = html_message_template.render(message_context)
+        send_mail(subject, text_message, settings.DEFAULT_FROM_EMAIL, [ email, ], html=html_message)
+
+
 def reply(request, cid):
     try:
         comment = XtdComment.objects.get(pk=cid)
@@ -193,29 +336,289 @@ def reply(request, cid):
                               context_instance=RequestContext(request))
 
 
+def list_for_object(request, id, app_model):
+    """
+    Page of the comments to the given object, in thread order. Pages are
+    selected with the cursor given in the ``after`` parameter, see
+    XtdComment.objects.page_for_object. With ``threads=1`` pages hold
+    COMMENTS_PER_PAGE whole threads instead of COMMENTS_PER_PAGE comments.
+    """
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        raise Http404
+    whole_threads = bool(request.GET.get('threads', False))
+    after = request.GET.get('after', None)
+    if after is not None:
+        try:
+            thread_id, order = after.split('-')
+            after = (int(thread_id), int(order))
+        except ValueError:
+            return HttpResponseBadRequest()
+
+    comments, next_cursor = XtdComment.objects.page_for_object(
+        contenttype, id, after=after, page_size=COMMENTS_PER_PAGE,
+        whole_threads=whole_threads)
+    template = get_comment_template(contenttype, name="comment_page.html")
+    context = RequestContext(request, {
+        "comment_list": comments,
+        # the page starts with replies to a comment of the previous page
+        "continued": bool(comments) and comments[0].level > 0,
+        "next_cursor": next_cursor and "%d-%d" % next_cursor,
+        "whole_threads": whole_threads,
+    })
+    return HttpResponse(template.render(context))
+
+
+def _tree_options(request):
+    """skip, depth and children parameters of the tree views."""
+    options = {'skip': 0, 'depth': TREE_MAX_DEPTH,
+               'children': TREE_MAX_CHILDREN}
+    for name in options:
+        value = request.GET.get(name, None)
+        if value is not None:
+            options[name] = int(value)
+            if options[name] < (name == 'skip' and 0 or 1):
+                raise ValueError("Bad %s" % name)
+    return options
+
+
+def replies(request, cid):
+    """
+    Replies to the given comment, rendered like render_xtdcomment_tree
+    does. The links to load more replies in the tree point here, with the
+    ``depth`` and ``children`` the tree was rendered with, that default to
+    TREE_MAX_DEPTH and TREE_MAX_CHILDREN. The ``skip`` parameter skips that
+    many direct replies.
+    """
+    comment = get_object_or_404(XtdComment, pk=cid, is_public=True)
+    try:
+        options = _tree_options(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    tree = XtdComment.objects.tree_for_object(
+        comment.content_type, comment.object_pk, root=comment,
+        max_depth=options['depth'], max_children=options['children'],
+        skip=options['skip'])
+    html = render_comment_tree(tree, RequestContext(request), parent=comment,
+                               skip=options['skip'],
+                               max_depth=options['depth'],
+                               max_children=options['children'])
+    return HttpResponse(html)
+
+
+def tree_for_object(request, id, app_model):
+    """
+    Top level comments to the given object, with their replies, rendered
+    like render_xtdcomment_tree does. Takes the same parameters as the view
+    replies; the links to load more top level comments point here.
+    """
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        raise Http404
+    try:
+        options = _tree_options(request)
+    except ValueError:
+        return HttpResponseBadRequest()
+    tree = XtdComment.objects.tree_for_object(
+        contenttype, id, max_depth=options['depth'],
+        max_children=options['children'], skip=options['skip'])
+    html = render_comment_tree(tree, RequestContext(request),
+                               skip=options['skip'],
+                               max_depth=options['depth'],
+                               max_children=options['children'])
+    return HttpResponse(html)
+
+
+def _last_for_object_version(request, count, id, app_model):
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        return None
+    return get_comments_version(contenttype.pk, id)
+
+
+def _last_for_object_etag(request, count, id, app_model):
+    version = _last_for_object_version(request, count, id, app_model)
+    if version is None:
+        return None
+    return md5("%s:%s:%s:%s:%s:%r" % (
+        app_model, id, count, bool(request.GET.get('reverse', False)),
+        bool(request.GET.get('batch', False)), version)).hexdigest()
+
+
+def _last_for_object_last_modified(request, count, id, app_model):
+    version = _last_for_object_version(request, count, id, app_model)
+    if version is None:
+        return None
+    return datetime.utcfromtimestamp(version)
+
+
+@condition(etag_func=_last_for_object_etag,
+           last_modified_func=_last_for_object_last_modified)
 def last_for_object(request, count, id, app_model):
     reverse = request.GET.get('reverse', False)
-    app, model = app_model.split('.')
-    contenttype = ContentType.objects.get_by_natural_key(app, model)
-    qs = XtdComment.objects.for_content_types(
-        [contenttype]).filter(object_pk=id)[:count]
+    batch = request.GET.get('batch', False)
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        raise Http404
+
+    if LAST_FOR_OBJECT_CACHE_TIMEOUT:
+        cache_key = "_xtd_last_for_object_%d_%s_%s_%d_%d_%r_" % (
+            contenttype.pk, id, count, bool(reverse), bool(batch),
+            get_comments_version(contenttype.pk, id))
+        html = cache.get(cache_key)
+        if html is not None:
+            return HttpResponse(html)
+
+    qs = XtdComment.objects.for_display(XtdComment.objects.for_content_types(
+        [contenttype]).filter(object_pk=id)[:count])
     if reverse:
-        qs = list(qs)
         qs.reverse()
 
-    template_arg = [
-        "django_comments_xtd/%s/%s/comment.html" % (
-            contenttype.app_label,
-            contenttype.model),
-        "django_comments_xtd/%s/comment.html" % (
-            contenttype.app_label,),
-        "django_comments_xtd/comment.html"
-    ]
-    strlist = []
-    for xtd_comment in qs:
-        strlist.append(
-            loader.render_to_string(
-                template_arg, {"comment": xtd_comment},
-                context_instance=RequestContext(request)))
-
-    return HttpResponse(''.join(strlist))
+    html = render_comments(qs, RequestContext(request), batch=bool(batch))
+
+    if LAST_FOR_OBJECT_CACHE_TIMEOUT:
+        cache.set(cache_key, html, LAST_FOR_OBJECT_CACHE_TIMEOUT)
+    return HttpResponse(html)
+
+
+def _comments_since_etag(request, id, app_model):
+    version = _last_for_object_version(request, None, id, app_model)
+    if version is None:
+        return None
+    return md5("%s:%s:%s:%s:%s:%r" % (
+        app_model, id, request.GET.get('after', ''),
+        request.GET.get('since', ''), request.GET.get('limit', ''),
+        version)).hexdigest()
+
+
+@condition(etag_func=_comments_since_etag)
+def comments_since(request, id, app_model):
+    """
+    JSON list with the short dict of the comments to the given object posted
+    after the comment given in the ``after`` parameter, or after the
+    ISO 8601 datetime given in ``since``. Returns at most ``limit``
+    comments, and the id to send as ``after`` in the next request.
+    """
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        raise Http404
+
+    try:
+        after = request.GET.get('after', None)
+        if after is not None:
+            after = int(after)
+        since = request.GET.get('since', None)
+        if since is not None:
+            since = parse_datetime(since)
+            if since is None:
+                raise ValueError("Bad since datetime")
+        limit = min(int(request.GET.get('limit', MAX_COMMENTS_SINCE)),
+                    MAX_COMMENTS_SINCE)
+        if limit < 1:
+            raise ValueError("Bad limit")
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    qs = XtdComment.objects.comments_since(contenttype, id, after_id=after,
+                                           since=since)[:limit]
+    comments = [comment.get_short_dict() for comment in qs]
+    if comments:
+        last_id = comments[-1]["id"]
+    else:
+        last_id = after
+    return HttpResponse(json.dumps({"comments": comments, "last_id": last_id}),
+                        content_type="application/json")
+
+
+def _new_comments(contenttype, object_pk, after):
+    qs = XtdComment.objects.comments_since(contenttype, object_pk,
+                                           after_id=after)
+    return [comment.get_short_dict() for comment in qs[:MAX_COMMENTS_SINCE]]
+
+
+def _stream_events(contenttype, object_pk, after):
+    """
+    Server-sent events with the new comments to the given object, for
+    STREAM_MAX_AGE seconds. The browser reconnects then, sending the id of
+    the last event in the Last-Event-ID header.
+    """
+    channel = get_channel(contenttype.pk, object_pk)
+    deadline = time.time() + STREAM_MAX_AGE
+    version = None
+    seen = after # newest comment published, found or not
+    while True:
+        current_version = get_comments_version(contenttype.pk, object_pk)
+        if current_version != version:
+            version = current_version
+            comments = _new_comments(contenttype, object_pk, after)
+            # do not hold a database connection while waiting
+            connection.close()
+            if comments:
+                after = comments[-1]["id"]
+                seen = max(seen, after)
+                yield "id: %d\ndata: %s\n\n" % (after, json.dumps(comments))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        published = get_broker().wait(channel, seen,
+                                      min(STREAM_TIMEOUT, remaining))
+        if published:
+            seen = max(seen, published)
+        else:
+            # lets the server notice clients that went away
+            yield ": keep-alive\n\n"
+
+
+def comments_stream(request, id, app_model):
+    """
+    Push the comments to the given object posted after the comment given in
+    the ``after`` parameter, or in the ``Last-Event-ID`` header.
+
+    Requested with ``Accept: text/event-stream`` the response is a stream of
+    server-sent events, one per batch of new comments, that lasts up to
+    COMMENTS_XTD_STREAM_MAX_AGE seconds. Otherwise it is a long
+    poll: the request waits up to COMMENTS_XTD_STREAM_TIMEOUT seconds for new
+    comments and returns them in JSON, with the ``last_id`` and ``version``
+    to send as ``after`` and ``version`` in the next request. When the
+    version sent is still the current one, the database is not queried
+    until a comment arrives.
+    """
+    try:
+        contenttype = get_content_type(app_model)
+    except ContentType.DoesNotExist:
+        raise Http404
+    try:
+        after = int(request.GET.get('after',
+                                    request.META.get('HTTP_LAST_EVENT_ID', 0)))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = StreamingHttpResponse(
+            _stream_events(contenttype, id, after),
+            content_type="text/event-stream")
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    channel = get_channel(contenttype.pk, id)
+    version = get_comments_version(contenttype.pk, id)
+    comments = []
+    if request.GET.get('version', None) != repr(version):
+        comments = _new_comments(contenttype, id, after)
+    if not comments:
+        # do not hold a database connection while waiting
+        connection.close()
+        if (get_broker().wait(channel, after, STREAM_TIMEOUT) or
+                get_comments_version(contenttype.pk, id) != version):
+            version = get_comments_version(contenttype.pk, id)
+            comments = _new_comments(contenttype, id, after)
+    if comments:
+        after = comments[-1]["id"]
+    return HttpResponse(json.dumps({"comments": comments, "last_id": after,
+                                    "version": repr(version)}),
+                        content_type="application/json")
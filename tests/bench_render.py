@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the rendering of the last comments of an object. 
+Compares rendering every comment with loader.render_to_string, as it used to
+be done, with utils.render_comments, per comment and in one pass.
+
+Run it from the root of the repository:
+
+    $ python tests/bench_render.py
+"""
+import sys
+import timeit
+from datetime import datetime
+
+from runtests import setup_django_settings
+
+
+def run_benchmark(number, count=100):
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection
+    from django.template import loader, RequestContext
+    from django.test.client import RequestFactory
+
+    from django_comments_xtd.models import XtdComment
+    from django_comments_xtd.tests.models import Article
+    from django_comments_xtd.utils import render_comments
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        article = Article.objects.create(title="September",
+                                         slug="september",
+                                         body="What I did on September...")
+        for i in range(count):
+            XtdComment.objects.create(content_object=article, site_id=1,
+                                      comment="Comment %d" % i,
+                                      submit_date=datetime.now())
+        comments = list(XtdComment.objects.all())
+        ctype = ContentType.objects.get_for_model(Article)
+        request = RequestFactory().get("/")
+
+        def per_comment_render_to_string():
+            template_arg = [
+                "django_comments_xtd/%s/%s/comment.html" % (
+                    ctype.app_label, ctype.model),
+                "django_comments_xtd/%s/comment.html" % (ctype.app_label,),
+                "django_comments_xtd/comment.html"
+            ]
+            return ''.join([
+                loader.render_to_string(
+                    template_arg, {"comment": comment},
+                    context_instance=RequestContext(request))
+                for comment in comments])
+
+        def per_comment():
+            return render_comments(comments, RequestContext(request))
+
+        def batched():
+            return render_comments(comments, RequestContext(request),
+                                   batch=True)
+
+        print "%d comments, %d runs" % (count, number)
+        print "%-30s %12s" % ("mode", "ms/render")
+        for name, func in (("render_to_string", per_comment_render_to_string),
+                           ("render_comments", per_comment),
+                           ("render_comments batch", batched)):
+            elapsed = timeit.timeit(func, number=number)
+            print "%-30s %12.2f" % (name, elapsed * 1000 / number)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict['NAME'],
+                                            verbosity=0)
+
+
+if __name__ == "__main__":
+    setup_django_settings()
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
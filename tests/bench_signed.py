@@ -0,0 +1,59 @@
+"""
+Micro-benchmark of the tokens of the comment confirmation URLs. Compares
+the pickle based signed.dumps/signed.loads with the compact format of
+signed.dumps_comment/signed.loads_comment.
+
+Run it from the root of the repository:
+
+    $ python tests/bench_signed.py
+"""
+import sys
+import timeit
+from datetime import datetime
+
+from runtests import setup_django_settings
+
+
+def run_benchmark(number):
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection
+
+    from django_comments_xtd import signed
+    from django_comments_xtd.models import TmpXtdComment
+    from django_comments_xtd.views import SALT
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        comment = TmpXtdComment(
+            content_type=ContentType.objects.get(app_label="tests",
+                                                 model="article"),
+            object_pk=u"1", site_id=1, user_name=u"Bob",
+            user_email=u"bob@example.com", user_url=u"",
+            comment=u"Es war einmal eine kleine Prinzessin... " * 20,
+            submit_date=datetime.now(), ip_address="127.0.0.1",
+            is_public=False, is_removed=False, thread_id=0, parent_id=0,
+            level=0, order=1, followup=True)
+        ContentType.objects.get_for_id(comment.content_type.pk) # warm cache
+
+        print "%-10s %10s %14s %14s" % ("format", "URL chars",
+                                        "encodes/s", "decodes/s")
+        for name, dumps, loads in (
+                ("pickle", signed.dumps, signed.loads),
+                ("compact", signed.dumps_comment, signed.loads_comment)):
+            key = dumps(comment, compress=True, extra_key=SALT)
+            encode = timeit.timeit(
+                lambda: dumps(comment, compress=True, extra_key=SALT),
+                number=number)
+            decode = timeit.timeit(lambda: loads(key, extra_key=SALT),
+                                   number=number)
+            print "%-10s %10d %14.0f %14.0f" % (name, len(key),
+                                                number / encode,
+                                                number / decode)
+    finally:
+        connection.creation.destroy_test_db(connection.settings_dict['NAME'],
+                                            verbosity=0)
+
+
+if __name__ == "__main__":
+    setup_django_settings()
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)